@@ -0,0 +1,278 @@
+"""
+设备应用索引：直接用 activity intent 打开应用，绕过 HOME → 上滑 → 抽屉里找图标。
+
+索引按设备保存在 APP_INDEX_DIR（默认 .app_index/）下，首次构建后按
+`pm list packages -f` 的差异增量刷新：只解析新增/更新过的包，删除已卸载的包。
+
+应用名（中/英）来源，按优先级合并:
+  1. APP_ALIASES_JSON 指向的别名文件 {"com.foo.bar": ["名字", "Name"]}
+  2. 设备上的 aapt（APP_INDEX_AAPT=/data/local/tmp/aapt）读取 application-label[-zh/-en]
+  3. 内置常见应用表 BUILTIN_LABELS
+只按展示名/别名匹配，不用包名分段（"tencent" 会把 "Tencent Video" 误配到微信）；
+没有任何名字的应用请在别名文件里补上。
+
+用法:
+  python app_index.py 127.0.0.1:7555            # 构建/刷新并列出
+  python app_index.py 127.0.0.1:7555 微信        # 模糊搜索
+"""
+import os, re, sys, json, time, subprocess
+from typing import Dict, Any, List, Optional
+
+from rapidfuzz import process, fuzz, utils
+
+from device_state import get_adb_state
+
+APP_INDEX_DIR = os.getenv("APP_INDEX_DIR", ".app_index")
+APP_INDEX_AAPT = os.getenv("APP_INDEX_AAPT")  # 设备上 aapt 的路径，可选
+APP_ALIASES_JSON = os.getenv("APP_ALIASES_JSON")
+# 名字来源规则变了就加一，旧索引整体重建（老版本里存了包名分段）
+INDEX_VERSION = 2
+MATCH_THRESHOLD = int(os.getenv("APP_INDEX_MATCH_THRESHOLD", "90"))
+# 查询与名字的长度比下限：挡住 "Wi-Fi settings" → "Settings" 这种包含关系
+MATCH_MIN_LEN_RATIO = float(os.getenv("APP_INDEX_MIN_LEN_RATIO", "0.8"))
+
+BUILTIN_LABELS = {
+    "com.android.settings": ["设置", "Settings"],
+    "com.android.chrome": ["Chrome", "谷歌浏览器"],
+    "com.android.browser": ["浏览器", "Browser"],
+    "com.android.camera": ["相机", "Camera"],
+    "com.android.camera2": ["相机", "Camera"],
+    "com.android.gallery3d": ["图库", "相册", "Gallery"],
+    "com.android.contacts": ["联系人", "Contacts"],
+    "com.android.dialer": ["电话", "拨号", "Phone"],
+    "com.android.mms": ["信息", "短信", "Messages"],
+    "com.android.messaging": ["信息", "短信", "Messages"],
+    "com.android.calendar": ["日历", "Calendar"],
+    "com.android.deskclock": ["时钟", "Clock"],
+    "com.android.calculator2": ["计算器", "Calculator"],
+    "com.android.documentsui": ["文件", "Files"],
+    "com.android.vending": ["Play 商店", "Play Store"],
+    "com.google.android.youtube": ["YouTube"],
+    "com.tencent.mm": ["微信", "WeChat"],
+    "com.tencent.mobileqq": ["QQ"],
+    "com.eg.android.AlipayGphone": ["支付宝", "Alipay"],
+    "com.taobao.taobao": ["淘宝", "Taobao"],
+    "com.ss.android.ugc.aweme": ["抖音", "Douyin", "TikTok"],
+    "com.sina.weibo": ["微博", "Weibo"],
+    "com.xingin.xhs": ["小红书", "Xiaohongshu", "RED"],
+    "com.sankuai.meituan": ["美团", "Meituan"],
+    "com.jingdong.app.mall": ["京东", "JD"],
+    "com.autonavi.minimap": ["高德地图", "Amap"],
+    "com.baidu.BaiduMap": ["百度地图", "Baidu Maps"],
+}
+
+_OPEN_GOAL_RE = [
+    re.compile(r"^\s*(?:please\s+)?(?:open|launch|start|run)\s+(?:the\s+)?(?P<name>.+?)(?:\s+app(?:lication)?)?\s*[.!。！]*\s*$", re.I),
+    re.compile(r"^\s*(?:请)?(?:打开|启动|运行|进入)(?P<name>.+?)(?:应用|app|APP)?\s*[.!。！]*\s*$"),
+]
+
+# 单字的 再/后 和英文 to 常出现在应用名里，只在前面是分隔符时才算连接词
+_COMPOUND_RE = re.compile(r"[,，;；]|\b(?:and|then)\b|\sto\s|并|然后|之后|以后|[\s,，;；](?:再|后)", re.I)
+
+
+# ---------- adb ----------
+def _adb_shell(host_port: str, cmd: str, timeout=30) -> str:
+    cp = subprocess.run(["adb", "-s", host_port, "shell", cmd], stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="replace",
+                        timeout=timeout)
+    if cp.returncode != 0:
+        raise RuntimeError(f"adb shell failed: {cmd}\n{cp.stdout}")
+    return cp.stdout
+
+
+def list_packages(host_port: str) -> Dict[str, str]:
+    """{package: apk_path}；apk 路径在应用更新后会变，用作增量刷新的版本标记"""
+    out = _adb_shell(host_port, "pm list packages -f")
+    pkgs = {}
+    for line in out.splitlines():
+        line = line.strip()
+        if not line.startswith("package:"):
+            continue
+        path, _, pkg = line[len("package:"):].rpartition("=")
+        if pkg:
+            pkgs[pkg] = path
+    return pkgs
+
+
+def query_launcher_activities(host_port: str) -> Dict[str, str]:
+    """一次调用拿到所有带 LAUNCHER category 的 activity：{package: component}"""
+    out = _adb_shell(host_port, "cmd package query-activities --brief "
+                                "-a android.intent.action.MAIN -c android.intent.category.LAUNCHER")
+    comps = {}
+    for line in out.splitlines():
+        m = re.match(r"^\s*([\w.]+)/([\w.$]+)\s*$", line)
+        if m:
+            comps.setdefault(m.group(1), f"{m.group(1)}/{m.group(2)}")
+    return comps
+
+
+def _aapt_labels(host_port: str, apk_path: str) -> List[str]:
+    out = _adb_shell(host_port, f"{APP_INDEX_AAPT} dump badging {apk_path} 2>/dev/null | grep application-label")
+    labels = []
+    for m in re.finditer(r"application-label(?:-(?:zh|zh-CN|en|en-US))?:'([^']+)'", out):
+        if m.group(1) not in labels:
+            labels.append(m.group(1))
+    return labels
+
+
+def _load_aliases() -> Dict[str, List[str]]:
+    if APP_ALIASES_JSON and os.path.exists(APP_ALIASES_JSON):
+        with open(APP_ALIASES_JSON, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def _labels_for(host_port: str, pkg: str, apk_path: str, aliases: Dict[str, List[str]]) -> List[str]:
+    labels = list(aliases.get(pkg, []))
+    if APP_INDEX_AAPT:
+        try:
+            labels += _aapt_labels(host_port, apk_path)
+        except Exception as e:
+            print("[APP_INDEX] aapt failed:", pkg, e)
+    labels += BUILTIN_LABELS.get(pkg, [])
+    seen, uniq = set(), []
+    for label in labels:
+        if label.lower() not in seen:
+            seen.add(label.lower())
+            uniq.append(label)
+    return uniq
+
+
+# ---------- 索引 ----------
+def _index_path(host_port: str) -> str:
+    return os.path.join(APP_INDEX_DIR, re.sub(r"[^\w.-]", "_", host_port) + ".json")
+
+
+def load_index(host_port: str) -> Dict[str, Any]:
+    path = _index_path(host_port)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") == INDEX_VERSION:
+            return index
+    return {"device": host_port, "version": INDEX_VERSION, "updated_at": 0, "apps": {}}
+
+
+def save_index(index: Dict[str, Any]):
+    os.makedirs(APP_INDEX_DIR, exist_ok=True)
+    path = _index_path(index["device"])
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def refresh_index(host_port: str) -> Dict[str, Any]:
+    """增量刷新：只为新增或 apk 路径变化的包解析 activity/名字"""
+    index = load_index(host_port)
+    apps = index["apps"]
+    installed = list_packages(host_port)
+
+    removed = [p for p in apps if p not in installed]
+    for pkg in removed:
+        del apps[pkg]
+    changed = [p for p, path in installed.items() if p not in apps or apps[p]["apk"] != path]
+
+    if changed:
+        activities = query_launcher_activities(host_port)
+        aliases = _load_aliases()
+        for pkg in changed:
+            comp = activities.get(pkg)
+            if not comp:
+                # 没有桌面入口的系统包：记下 apk 路径，下次不再重复解析
+                apps[pkg] = {"apk": installed[pkg], "activity": None, "labels": []}
+                continue
+            apps[pkg] = {"apk": installed[pkg], "activity": comp,
+                         "labels": _labels_for(host_port, pkg, installed[pkg], aliases)}
+
+    if changed or removed or not index["updated_at"]:
+        index["updated_at"] = int(time.time())
+        save_index(index)
+        print(f"[APP_INDEX] {host_port}: +{len(changed)} -{len(removed)}, "
+              f"{sum(1 for a in apps.values() if a['activity'])} launchable")
+    return index
+
+
+def search_app(index: Dict[str, Any], query: str, threshold: int = MATCH_THRESHOLD) -> Optional[Dict[str, Any]]:
+    """按名字模糊搜索可启动应用，返回 {package, activity, label, score, exact}；
+    exact 表示查询与某个名字整体一致（忽略大小写、标点和词序）"""
+    choices = {}
+    for pkg, app in index["apps"].items():
+        if not app["activity"]:
+            continue
+        for label in app["labels"]:
+            choices[(pkg, label)] = label
+    q = utils.default_process(query)
+    if not choices or not q:
+        return None
+    hits = process.extract(q, choices, scorer=fuzz.token_sort_ratio, processor=utils.default_process,
+                           score_cutoff=threshold, limit=5)
+    for _, score, (pkg, label) in hits:
+        name = utils.default_process(label)
+        if min(len(q), len(name)) / max(len(q), len(name)) < MATCH_MIN_LEN_RATIO:
+            continue
+        return {"package": pkg, "activity": index["apps"][pkg]["activity"], "label": label,
+                "score": score, "exact": score >= 100}
+    return None
+
+
+def parse_open_goal(goal: str) -> Optional[str]:
+    """从 "Open the Settings app." / "打开微信" 之类的目标里取出应用名"""
+    for pat in _OPEN_GOAL_RE:
+        m = pat.match(goal or "")
+        if not m:
+            continue
+        name = m.group("name").strip()
+        # 复合目标（"打开设置并开启 WiFi"）不能只靠启动应用完成，交给视觉循环
+        if not name or len(name) > 30 or _COMPOUND_RE.search(name):
+            return None
+        return name
+    return None
+
+
+# ---------- 启动 ----------
+def launch_app(host_port: str, component: str) -> bool:
+    """一次 adb 调用通过 activity intent 启动应用"""
+    out = _adb_shell(host_port, f"am start -n {component}")
+    return "Error" not in out and "Exception" not in out
+
+
+def try_direct_launch(host_port: str, goal: str) -> Optional[str]:
+    """"打开 X" 类目标直接启动。
+    返回 "done"：名字整体命中且应用已在前台，视觉循环可以跳过；
+    返回 "launched"：只是近似命中，应用已启动，交给视觉循环确认/继续；
+    返回 None：没有启动，按原流程走视觉循环"""
+    name = parse_open_goal(goal)
+    if not name:
+        return None
+    try:
+        index = refresh_index(host_port)
+        hit = search_app(index, name)
+        if not hit:
+            print(f"[APP_INDEX] no match for {name!r}, fallback to vision loop")
+            return None
+        print(f"[APP_INDEX] {name!r} → {hit['label']} ({hit['activity']}, score={hit['score']:.0f})")
+        if not launch_app(host_port, hit["activity"]):
+            return None
+        if not hit["exact"]:
+            return "launched"
+        time.sleep(1.0)  # 等待 activity 起来再看前台
+        state = get_adb_state(host_port)
+        state.invalidate_foreground()  # 刚启动过应用，缓存的前台包名已过期
+        return "done" if state.foreground() == hit["package"] else "launched"
+    except Exception as e:
+        print("[APP_INDEX] direct launch failed:", e)
+        return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python app_index.py <host:port> [query]")
+        sys.exit(1)
+    idx = refresh_index(sys.argv[1])
+    if len(sys.argv) > 2:
+        print(search_app(idx, " ".join(sys.argv[2:])))
+    else:
+        for p, a in sorted(idx["apps"].items()):
+            if a["activity"]:
+                print(f"{a['activity']:<70} {' / '.join(a['labels'])}")
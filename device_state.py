@@ -0,0 +1,189 @@
+"""
+设备状态缓存：当前方向下的分辨率、方向、density、前台包名。
+
+一次性探测（adb 一次 shell 调用 / Appium 一张截图 + 方向/density），之后靠廉价信号失效:
+- observe_frame(png)：只读 PNG 头里的宽高（不解码），尺寸变了说明旋转或改了分辨率；
+  旋转时方向失效，分辨率变化时方向和 density 都失效，用到时再探测
+- invalidate_foreground()：每次动作后调用，前台包名下次用到时再查
+
+尺寸一律是截图像素（含导航栏），和模型看到的坐标空间一致；Appium 的 get_window_size
+不含导航栏，和截图比会误报“分辨率变化”，所以不用它。
+
+坐标映射和方向滑动都从这里取尺寸，每步不再有远程往返。
+纯几何工具（fit_size / swipe_points）也放在这里，供各模块共用。
+"""
+import re, struct, subprocess
+from typing import Callable, Dict, Optional, Tuple
+
+_PNG_SIG = b"\x89PNG\r\n\x1a\n"
+
+
+# ---------- 几何 ----------
+def fit_size(w: int, h: int, max_side: int) -> Tuple[int, int]:
+    """等比缩放到长边不超过 max_side（发给模型的截图尺寸都按这个算）"""
+    s = min(1.0, max_side / float(max(w, h)))
+    return (int(w * s), int(h * s)) if s < 1.0 else (w, h)
+
+
+def swipe_points(direction: str, W: int, H: int):
+    """滑动起止点；幅度控制在 ~40% 屏幕，保证相邻两屏有重叠，不会跳过条目"""
+    if direction == "down":
+        return int(W * 0.5), int(H * 0.3), int(W * 0.5), int(H * 0.7)
+    if direction == "left":
+        return int(W * 0.8), int(H * 0.5), int(W * 0.2), int(H * 0.5)
+    if direction == "right":
+        return int(W * 0.2), int(H * 0.5), int(W * 0.8), int(H * 0.5)
+    return int(W * 0.5), int(H * 0.7), int(W * 0.5), int(H * 0.3)  # up
+
+
+def png_size(png_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """从 IHDR 读宽高，不解码整张图"""
+    if len(png_bytes) < 24 or not png_bytes.startswith(_PNG_SIG):
+        return None
+    return struct.unpack(">II", png_bytes[16:24])
+
+
+class DeviceState:
+    def __init__(self, device_id: str, probe: Callable[[], dict], probe_foreground: Callable[[], Optional[str]]):
+        """probe() 返回 {size:(W,H), orientation:0-3|None, density:int|None}，只在缓存失效时调用"""
+        self.device_id = device_id
+        self._probe = probe
+        self._probe_foreground = probe_foreground
+        self._size = None
+        self._orientation = None
+        self._density = None
+        self._foreground = None
+        self.probes = 0  # 远程探测次数，便于确认缓存有效
+
+    def _fill(self):
+        info = self._probe()
+        self.probes += 1
+        self._size = tuple(info["size"])
+        self._orientation = info.get("orientation")
+        self._density = info.get("density")
+
+    # ---------- 读取 ----------
+    @property
+    def size(self) -> Tuple[int, int]:
+        """当前方向下的 (W, H) 像素"""
+        if self._size is None:
+            self._fill()
+        return self._size
+
+    @property
+    def orientation(self) -> Optional[int]:
+        """0=竖屏，1/3=横屏（Surface 旋转角 / 90）"""
+        if self._size is None or self._orientation is None:
+            self._fill()
+        return self._orientation
+
+    @property
+    def density(self) -> Optional[int]:
+        if self._size is None or self._density is None:
+            self._fill()
+        return self._density
+
+    def foreground(self) -> Optional[str]:
+        if self._foreground is None:
+            self._foreground = self._probe_foreground()
+        return self._foreground
+
+    def swipe_points(self, direction: str):
+        return swipe_points(direction, *self.size)
+
+    # ---------- 失效 ----------
+    def observe_frame(self, png_bytes: bytes) -> Tuple[int, int]:
+        """每次截图后调用；尺寸变化时更新缓存，返回当前 (W, H)"""
+        frame = png_size(png_bytes)
+        if frame is None:
+            return self.size
+        if self._size is None:
+            # 截图本身就是坐标空间，首帧直接作为尺寸，不做远程探测
+            self._size = frame
+            return self._size
+        if frame != self._size:
+            if frame == self._size[::-1]:
+                # 宽高互换 = 旋转；具体方向（90/270）用到时再查
+                print(f"[DEVICE] {self.device_id} rotated: {self._size} -> {frame}")
+                self._orientation = None
+            else:
+                print(f"[DEVICE] {self.device_id} resolution changed: {self._size} -> {frame}")
+                self._orientation = self._density = None
+            self._size = frame
+            self._foreground = None
+        return self._size
+
+    def invalidate_foreground(self):
+        self._foreground = None
+
+    def invalidate(self):
+        self._size = self._orientation = self._density = self._foreground = None
+
+
+# ---------- adb 后端 ----------
+def _adb_probe(host_port: str) -> dict:
+    # 一次 shell 往返拿到 size / density / orientation
+    out = subprocess.run(
+        ["adb", "-s", host_port, "shell",
+         "wm size; wm density; dumpsys input | grep -m1 SurfaceOrientation"],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=15).stdout
+
+    def last(pattern):
+        found = re.findall(pattern, out)
+        return found[-1] if found else None  # Override 行在 Physical 之后，优先生效
+
+    wh = last(r"size:\s*(\d+)x(\d+)")
+    if not wh:
+        raise RuntimeError(f"cannot read screen size from device {host_port}: {out[:200]}")
+    density = last(r"density:\s*(\d+)")
+    orientation = last(r"SurfaceOrientation:\s*(\d)")
+    W, H = int(wh[0]), int(wh[1])
+    o = int(orientation) if orientation is not None else 0
+    if o in (1, 3):  # wm size 给的是自然方向，横屏时交换
+        W, H = H, W
+    return {"size": (W, H), "orientation": o if orientation is not None else None,
+            "density": int(density) if density else None}
+
+
+def _adb_foreground(host_port: str) -> Optional[str]:
+    out = subprocess.run(["adb", "-s", host_port, "shell", "dumpsys window | grep -E 'mCurrentFocus|mFocusedApp'"],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=15).stdout
+    m = re.search(r"\s([\w.]+)/[\w.$]+", out)
+    return m.group(1) if m else None
+
+
+# ---------- Appium 后端 ----------
+_ORIENTATION = {"PORTRAIT": 0, "LANDSCAPE": 1}
+
+
+def _appium_probe(driver) -> dict:
+    # 尺寸取截图的，和 observe_frame 比较的是同一个东西（get_window_size 不含导航栏）
+    size = png_size(driver.get_screenshot_as_png())
+    if size is None:
+        s = driver.get_window_size()
+        size = (s["width"], s["height"])
+    info = {"size": size, "orientation": None, "density": None}
+    try:
+        info["orientation"] = _ORIENTATION.get(str(driver.orientation).upper())
+        info["density"] = int(driver.get_display_density())
+    except Exception:
+        pass
+    return info
+
+
+# 每台设备一个缓存实例
+_STATES: Dict[str, DeviceState] = {}
+
+
+def get_adb_state(host_port: str) -> DeviceState:
+    if host_port not in _STATES:
+        _STATES[host_port] = DeviceState(host_port, lambda: _adb_probe(host_port),
+                                         lambda: _adb_foreground(host_port))
+    return _STATES[host_port]
+
+
+def get_appium_state(driver, device_id: str) -> DeviceState:
+    if device_id not in _STATES:
+        _STATES[device_id] = DeviceState(device_id, lambda: _appium_probe(driver),
+                                         lambda: driver.current_package)
+    return _STATES[device_id]
@@ -0,0 +1,276 @@
+"""
+动作前后截图差分：verify 只上传变化区域，没变化就跳过 verify。
+
+流程（numpy 向量化，差分本身几毫秒，主要耗时在 PNG 解码）:
+  1. 前后两帧转灰度、按整数倍缩小到长边约 DIFF_SIDE
+  2. 逐像素差 > PIXEL_THRESH 记为变化，再按 BLOCK×BLOCK 块统计变化比例
+  3. 变化块做 8 邻域连通，得到若干变化区域（设备像素 bbox）
+
+verify 载荷:
+  skip  无变化（状态栏时钟等顶部 IGNORE_TOP 区域不计）→ 不调用模型
+  crop  变化区域并集不大 → 全屏 low detail 缩略图 + 变化区域高清裁剪
+  full  尺寸变了（旋转）或变化面积超过 FULL_FRAC → 照旧发整帧
+
+每次 verify 记录实际上传字节 / 图片 token / 耗时，与整帧基线对比，见 STATS.summary()。
+基线不额外编码：token 按尺寸算，字节按近期实际发送的整帧 JPEG 的每像素字节数估算。
+所以 skip / crop 的基线和“省下的”字节、token 都是估算值，summary 里带 _est 后缀；
+只有 full 的基线是实际发送量。
+
+  python frame_diff.py before.png after.png
+"""
+import io, os, sys, base64, time, threading
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from device_state import fit_size
+from prompt_compiler import estimate_image_tokens
+
+DIFF_SIDE = 320  # 差分工作分辨率（长边）
+BLOCK = 8  # 块大小（工作分辨率像素）
+PIXEL_THRESH = int(os.getenv("FRAME_DIFF_PIXEL_THRESH", "24"))  # 灰度差阈值，滤掉抗锯齿/渐变噪声
+BLOCK_FRAC = 0.04  # 块内变化像素占比超过它才算变化块
+IGNORE_TOP = float(os.getenv("FRAME_DIFF_IGNORE_TOP", "0.04"))  # 顶部状态栏（时钟、信号）不参与判断
+FULL_FRAC = float(os.getenv("FRAME_DIFF_FULL_FRAC", "0.5"))  # 变化并集超过整屏这个比例就直接发整帧
+CROP_PAD = 0.03  # 裁剪框向外扩的边距（占屏幕短边）
+THUMB_SIDE = 384  # 全屏缩略图长边
+FULL_SIDE = 1024  # 整帧基线的长边（与各 POC 默认一致）
+JPEG_QUALITY = 85
+
+
+def _gray_small(img: Image.Image) -> np.ndarray:
+    # reduce 是整数倍盒式下采样，比 resize 快且自带平滑
+    factor = max(1, -(-max(img.size) // DIFF_SIDE))
+    return np.asarray(img.convert("L").reduce(factor), dtype=np.int16)
+
+
+# ---------- 差分 ----------
+def changed_blocks(pre: np.ndarray, post: np.ndarray) -> np.ndarray:
+    """两张同尺寸灰度小图 → 变化块布尔网格 (rows, cols)"""
+    h, w = pre.shape
+    changed = np.abs(post - pre) > PIXEL_THRESH
+    changed[:int(round(h * IGNORE_TOP))] = False
+    rows, cols = -(-h // BLOCK), -(-w // BLOCK)
+    padded = np.zeros((rows * BLOCK, cols * BLOCK), dtype=np.float32)
+    padded[:h, :w] = changed
+    frac = padded.reshape(rows, BLOCK, cols, BLOCK).mean(axis=(1, 3))
+    return frac > BLOCK_FRAC
+
+
+def connected_regions(grid: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """8 邻域连通，返回每个连通块的 (r0, c0, r1, c1)，右下为开区间"""
+    seen = np.zeros_like(grid, dtype=bool)
+    rows, cols = grid.shape
+    regions = []
+    for r, c in zip(*np.nonzero(grid)):
+        if seen[r, c]:
+            continue
+        seen[r, c] = True
+        stack, r0, c0, r1, c1 = [(r, c)], r, c, r, c
+        while stack:
+            y, x = stack.pop()
+            r0, c0, r1, c1 = min(r0, y), min(c0, x), max(r1, y), max(c1, x)
+            for ny in (y - 1, y, y + 1):
+                for nx in (x - 1, x, x + 1):
+                    if 0 <= ny < rows and 0 <= nx < cols and grid[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        stack.append((ny, nx))
+        regions.append((int(r0), int(c0), int(r1) + 1, int(c1) + 1))
+    return regions
+
+
+def diff_frames(pre_png: bytes, post_png: bytes, model: str = "") -> Dict[str, Any]:
+    """
+    返回 {kind: skip|crop|full, regions: [(x,y,w,h)...], crop_bbox, changed_frac, size, image, diff_ms}，
+    坐标均为 post 帧设备像素；image 是解码后的 post 帧，供后续编码复用。
+    给了 model 时，缩略图 + 裁剪的估算 token 不少于整帧就退回 full（OpenAI 按 512 切片计费，大裁剪不划算）。
+    """
+    t0 = time.perf_counter()
+    pre = Image.open(io.BytesIO(pre_png))
+    post = Image.open(io.BytesIO(post_png))  # 转 RGB 留到编码时，skip 不需要
+    W, H = post.size
+    plan = {"kind": "full", "regions": [], "crop_bbox": None, "changed_frac": 1.0, "size": (W, H), "image": post}
+    if pre.size != post.size:
+        plan["diff_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return plan  # 旋转或分辨率变化，无从比较
+
+    g0, g1 = _gray_small(pre), _gray_small(post)
+    grid = changed_blocks(g0, g1)
+    # 块坐标 → 设备像素
+    sx, sy = W / float(g1.shape[1]) * BLOCK, H / float(g1.shape[0]) * BLOCK
+    regions = []
+    for r0, c0, r1, c1 in connected_regions(grid):
+        x0, y0 = int(c0 * sx), int(r0 * sy)
+        x1, y1 = min(W, int(round(c1 * sx))), min(H, int(round(r1 * sy)))
+        regions.append((x0, y0, x1 - x0, y1 - y0))
+    plan["regions"] = regions
+
+    if not regions:
+        plan.update(kind="skip", changed_frac=0.0)
+    else:
+        pad = int(min(W, H) * CROP_PAD)
+        x0 = max(0, min(x for x, _, _, _ in regions) - pad)
+        y0 = max(0, min(y for _, y, _, _ in regions) - pad)
+        x1 = min(W, max(x + w for x, _, w, _ in regions) + pad)
+        y1 = min(H, max(y + h for _, y, _, h in regions) + pad)
+        plan["crop_bbox"] = (x0, y0, x1 - x0, y1 - y0)
+        plan["changed_frac"] = round((x1 - x0) * (y1 - y0) / float(W * H), 4)
+        if plan["changed_frac"] <= FULL_FRAC and (not model or _crop_tokens(plan, model) < _full_tokens(plan, model)):
+            plan["kind"] = "crop"
+    plan["diff_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return plan
+
+
+# ---------- 载荷 ----------
+def _jpeg(img: Image.Image, max_side: int) -> Tuple[bytes, Tuple[int, int]]:
+    size = fit_size(*img.size, max_side)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if size != img.size:
+        img = img.resize(size)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue(), size
+
+
+def _data_url(jpeg: bytes) -> str:
+    return "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()
+
+
+def thumb_size(plan: Dict[str, Any]) -> Tuple[int, int]:
+    return fit_size(*plan["size"], THUMB_SIDE)
+
+
+def crop_size(plan: Dict[str, Any]) -> Tuple[int, int]:
+    return tuple(plan["crop_bbox"][2:])
+
+
+def _crop_tokens(plan: Dict[str, Any], model: str) -> int:
+    return (estimate_image_tokens(thumb_size(plan), model, "low")
+            + estimate_image_tokens(fit_size(*crop_size(plan), FULL_SIDE), model))
+
+
+def _full_tokens(plan: Dict[str, Any], model: str) -> int:
+    return estimate_image_tokens(fit_size(*plan["size"], FULL_SIDE), model)
+
+
+def crop_note(plan: Dict[str, Any]) -> str:
+    """给 verify 的说明：两张图分别是什么，裁剪框在屏幕上的位置"""
+    x, y, w, h = plan["crop_bbox"]
+    W, H = plan["size"]
+    return (f"Image 1: whole screen thumbnail. Image 2: full-resolution crop of the area that changed "
+            f"after the last action, at x={x} y={y} w={w} h={h} on a {W}x{H} screen. "
+            f"The rest of the screen did not change.")
+
+
+def crop_images(plan: Dict[str, Any], max_side: int) -> List[Dict[str, Any]]:
+    """crop 载荷：[缩略图, 变化区域裁剪]，每项 {data_url, bytes, size}"""
+    img = plan["image"]
+    x, y, w, h = plan["crop_bbox"]
+    out = []
+    for jpeg, size in (_jpeg(img, THUMB_SIDE), _jpeg(img.crop((x, y, x + w, y + h)), max_side)):
+        out.append({"data_url": _data_url(jpeg), "bytes": len(jpeg), "size": size})
+    return out
+
+
+def full_image(plan: Dict[str, Any], max_side: int) -> Dict[str, Any]:
+    """full 载荷：直接用 diff_frames 解码好的整帧编码，不再解码一次 PNG"""
+    jpeg, size = _jpeg(plan["image"], max_side)
+    return {"data_url": _data_url(jpeg), "bytes": len(jpeg), "size": size}
+
+
+def image_tokens(images: List[Dict[str, Any]], model: str, detail: str = "high") -> int:
+    """crop 载荷的图片 token：缩略图按 low detail，裁剪按 detail"""
+    return sum(estimate_image_tokens(im["size"], model, "low" if i == 0 else detail) for i, im in enumerate(images))
+
+
+# ---------- 统计 ----------
+class VerifyStats:
+    """按载荷类型累计上传字节、图片 token、耗时，以及同样调用如果发整帧的基线（估算）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_kind = {}
+        self._full_bytes = self._full_pixels = 0  # 实际发送过的整帧 JPEG，用来估算基线字节
+
+    def observe_full(self, nbytes: int, size: Tuple[int, int]):
+        """每次发送整帧（think 或 full verify）后调用，积累每像素字节数"""
+        with self._lock:
+            self._full_bytes += nbytes
+            self._full_pixels += size[0] * size[1]
+
+    def _baseline_bytes(self, size: Tuple[int, int]) -> int:
+        w, h = fit_size(*size, FULL_SIDE)
+        with self._lock:
+            bpp = self._full_bytes / float(self._full_pixels) if self._full_pixels else 0.0
+        return int(bpp * w * h)
+
+    def record(self, plan: Dict[str, Any], model: str, sent_bytes: int = 0, sent_tokens: int = 0,
+               latency_s: float = 0.0):
+        """skip 时 sent_* 为 0；full 时基线就是实际发送，其余按尺寸估算，不在主循环里额外编码"""
+        if plan["kind"] == "full":
+            base_bytes, base_tokens = sent_bytes, sent_tokens
+        else:
+            base_bytes = self._baseline_bytes(plan["size"])
+            base_tokens = estimate_image_tokens(fit_size(*plan["size"], FULL_SIDE), model)
+        with self._lock:
+            k = self.by_kind.setdefault(plan["kind"], {"calls": 0, "bytes": 0, "base_bytes": 0, "tokens": 0,
+                                                       "base_tokens": 0, "latency_s": 0.0, "diff_ms": 0.0})
+            k["calls"] += 1
+            k["bytes"] += sent_bytes
+            k["base_bytes"] += base_bytes
+            k["tokens"] += sent_tokens
+            k["base_tokens"] += base_tokens
+            k["latency_s"] += latency_s
+            k["diff_ms"] += plan.get("diff_ms", 0.0)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            kinds = {name: dict(v) for name, v in self.by_kind.items()}
+        total = {key: sum(v[key] for v in kinds.values()) for key in ("bytes", "base_bytes", "tokens", "base_tokens")}
+        out = {"kinds": {}, "bytes_saved_est": total["base_bytes"] - total["bytes"],
+               "tokens_saved_est": total["base_tokens"] - total["tokens"]}
+        for name, v in kinds.items():
+            out["kinds"][name] = {
+                "calls": v["calls"],
+                "avg_kb": round(v["bytes"] / v["calls"] / 1024.0, 1),
+                "avg_base_kb_est": round(v["base_bytes"] / v["calls"] / 1024.0, 1),
+                "avg_tokens": v["tokens"] // v["calls"],
+                "avg_base_tokens_est": v["base_tokens"] // v["calls"],
+                "avg_latency_s": round(v["latency_s"] / v["calls"], 2),
+                "avg_diff_ms": round(v["diff_ms"] / v["calls"], 1),
+            }
+        # 整帧 verify 的平均耗时就是延迟基线；跳过的调用按它折算省下的时间
+        full = out["kinds"].get("full")
+        if full and "skip" in out["kinds"]:
+            out["latency_saved_s_est"] = round(full["avg_latency_s"] * out["kinds"]["skip"]["calls"], 2)
+        return out
+
+
+# 进程内共享
+STATS = VerifyStats()
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: python frame_diff.py <before.png> <after.png>")
+        return
+    frames = []
+    for path in sys.argv[1:3]:
+        with open(path, "rb") as f:
+            frames.append(f.read())
+    pre, post = frames
+    plan = diff_frames(pre, post)
+    print(f"kind={plan['kind']} changed={plan['changed_frac']} diff={plan['diff_ms']}ms")
+    for r in plan["regions"]:
+        print("  region", r)
+    if plan["kind"] == "crop":
+        imgs = crop_images(plan, FULL_SIDE)
+        full_jpeg, full_size = _jpeg(plan["image"], FULL_SIDE)
+        print(f"  crop {plan['crop_bbox']} → {[i['size'] for i in imgs]}, "
+              f"{sum(i['bytes'] for i in imgs) // 1024}KB vs full {len(full_jpeg) // 1024}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+组合手势宏：把 tap / text / keyevent / swipe / wait 序列编译成一个 shell 脚本，一次 adb 往返执行。
+
+模型输出:
+  {"action": "macro", "steps": [
+      {"op": "tap", "bbox": [x, y, w, h]},
+      {"op": "text", "text": "北京 weather"},
+      {"op": "keyevent", "keycode": 66}
+  ]}
+
+坐标字段与顶层动作相同（bbox / tap_point / norm_bbox / norm_point / swipe_*），
+由各 POC 传入的 resolve(step) 映射成设备像素，宏本身不关心坐标空间。
+
+文本输入:
+- 可打印 ASCII 走 `input text`，空格转 %s，整段做 shell 引用；换行转 ENTER
+- 非 ASCII 走 Unicode 通道（UNICODE_TEXT_METHOD，调用方可用 method 参数按会话覆盖）:
+    adbkeyboard  ADBKeyBoard 输入法的 ADB_INPUT_B64 广播（默认）。需要先安装并设为当前输入法:
+                   adb shell ime enable com.android.adbkeyboard/.AdbIME
+                   adb shell ime set com.android.adbkeyboard/.AdbIME
+                 am broadcast 没有接收者也返回 0，所以脚本先检查当前输入法，不是 ADBKeyBoard 就报错，
+                 不会静默丢字
+    clipboard    Appium Settings 写剪贴板 + KEYCODE_PASTE（Appium 会话已装好 io.appium.settings）。
+                 Appium 会话开了 unicodeKeyboard 时当前输入法是 Appium 的，adbkeyboard 必然失败，要用这个
+
+宏来自模型输出，按不可信输入处理：任何校验或执行失败都抛 MacroError，调用方按失败的一步处理。
+"""
+import os, re, base64, shlex, subprocess
+from typing import Callable, Dict, Any, List, Tuple
+
+from device_state import swipe_points
+
+UNICODE_TEXT_METHOD = os.getenv("UNICODE_TEXT_METHOD", "adbkeyboard")
+MAX_MACRO_STEPS = 20
+KEYCODE_ENTER, KEYCODE_PASTE = 66, 279
+
+ADBKEYBOARD_IME = "com.android.adbkeyboard/.AdbIME"
+SWIPE_DIRECTIONS = ("up", "down", "left", "right")
+
+_ASCII_RE = re.compile(r"^[\x20-\x7e]*$")
+
+
+class MacroError(Exception):
+    """宏校验或执行失败"""
+
+
+# ---------- 文本 ----------
+def _ascii_text_cmd(text: str) -> str:
+    # input text 只认 %s 为空格；其余字符靠 shell 单引号原样传入
+    return "input text " + shlex.quote(text.replace(" ", "%s"))
+
+
+def _unicode_text_cmds(text: str, method: str) -> List[str]:
+    b64 = base64.b64encode(text.encode("utf-8")).decode()
+    if method == "clipboard":
+        return [f"am broadcast -a io.appium.settings.clipboard.set --es content {b64} "
+                f"io.appium.settings/.receivers.ClipboardReceiver >/dev/null",
+                f"input keyevent {KEYCODE_PASTE}"]
+    check = (f"{{ [ \"$(settings get secure default_input_method)\" = {ADBKEYBOARD_IME} ] || "
+             f"{{ echo 'ADBKeyBoard is not the active IME, run: ime set {ADBKEYBOARD_IME}'; false; }}; }}")
+    return [check, f"am broadcast -a ADB_INPUT_B64 --es msg {b64} >/dev/null"]
+
+
+def text_commands(text: str, method: str = None) -> List[str]:
+    """一段文本 → shell 命令；多行文本按行输入，行间补 ENTER。method 缺省取 UNICODE_TEXT_METHOD"""
+    method = method or UNICODE_TEXT_METHOD
+    cmds = []
+    for i, line in enumerate(text.split("\n")):
+        if i:
+            cmds.append(f"input keyevent {KEYCODE_ENTER}")
+        if not line:
+            continue
+        cmds.extend([_ascii_text_cmd(line)] if _ASCII_RE.match(line) else _unicode_text_cmds(line, method))
+    return cmds
+
+
+# ---------- 编译 ----------
+def _int(step: Dict[str, Any], key: str, default: int = None) -> int:
+    value = step.get(key, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise MacroError(f"macro {step.get('op')} step needs integer {key!r}: {step}")
+
+
+def _resolve(resolve: Callable[[dict], dict], step: Dict[str, Any]) -> dict:
+    # 坐标字段格式不对（不是数字、长度不够）时 resolve 会抛各种异常，统一成 MacroError
+    try:
+        return resolve(step)
+    except (TypeError, ValueError, KeyError, IndexError) as e:
+        raise MacroError(f"macro {step.get('op')} step has bad coordinates: {step} ({e})")
+
+
+def compile_macro(steps: List[Dict[str, Any]], resolve: Callable[[dict], dict], size: Tuple[int, int],
+                  text_method: str = None) -> List[str]:
+    """
+    steps: 宏步骤；resolve(step) 返回 {"tap_px": (x,y)} 或 {"swipe_from_px":..., "swipe_to_px":...}；
+    size: 设备 (W, H)，用于只给方向的滑动；text_method: 非 ASCII 文本通道，缺省取 UNICODE_TEXT_METHOD。
+    步骤不合法时抛 MacroError。
+    """
+    if not isinstance(steps, list) or not steps:
+        raise MacroError(f"macro needs a non-empty list of steps: {steps!r}")
+    if len(steps) > MAX_MACRO_STEPS:
+        raise MacroError(f"macro too long: {len(steps)} > {MAX_MACRO_STEPS} steps")
+    cmds = []
+    for step in steps:
+        if not isinstance(step, dict):
+            raise MacroError(f"macro step must be an object: {step!r}")
+        op = step.get("op")
+        if op in ("tap", "long_tap"):
+            mapped = _resolve(resolve, step)
+            if "tap_px" not in mapped:
+                raise MacroError(f"macro {op} step has no coordinates: {step}")
+            x, y = mapped["tap_px"]
+            if op == "long_tap":
+                cmds.append(f"input swipe {x} {y} {x} {y} {_int(step, 'duration_ms', 500)}")
+            else:
+                cmds.append(f"input tap {x} {y}")
+        elif op == "text":
+            cmds.extend(text_commands(str(step.get("text", "")), text_method))
+        elif op == "keyevent":
+            cmds.append(f"input keyevent {_int(step, 'keycode')}")
+        elif op == "swipe":
+            mapped = _resolve(resolve, step)
+            if "swipe_from_px" in mapped and "swipe_to_px" in mapped:
+                (x0, y0), (x1, y1) = mapped["swipe_from_px"], mapped["swipe_to_px"]
+            else:
+                direction = step.get("swipe", "up")
+                if direction not in SWIPE_DIRECTIONS:
+                    raise MacroError(f"macro swipe step has bad direction: {step}")
+                x0, y0, x1, y1 = swipe_points(direction, *size)
+            cmds.append(f"input swipe {x0} {y0} {x1} {y1} {_int(step, 'duration_ms', 300)}")
+        elif op == "wait":
+            cmds.append(f"sleep {max(0, _int(step, 'wait_ms', 300)) / 1000.0:.3f}")
+        else:
+            raise MacroError(f"unknown macro op: {op!r}")
+    if not cmds:
+        raise MacroError(f"macro produced no commands: {steps}")
+    return cmds
+
+
+def run_shell_script(host_port: str, cmds: List[str], timeout: float = 30) -> str:
+    """&& 串联：任一步失败就停下，不在错误界面上继续盲打；失败抛 MacroError"""
+    if not cmds:
+        raise MacroError("empty shell script")
+    script = " && ".join(cmds)
+    cp = subprocess.run(["adb", "-s", host_port, "shell", script], stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="replace", timeout=timeout)
+    if cp.returncode != 0:
+        raise MacroError(f"macro failed: {script}\n{cp.stdout}")
+    return cp.stdout
+
+
+def run_macro(host_port: str, steps: List[Dict[str, Any]], resolve: Callable[[dict], dict],
+              size: Tuple[int, int], timeout: float = 30, text_method: str = None) -> str:
+    cmds = compile_macro(steps, resolve, size, text_method)
+    print(f"[MACRO] {len(steps)} step(s) in one adb shell call")
+    return run_shell_script(host_port, cmds, timeout)
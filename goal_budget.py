@@ -0,0 +1,171 @@
+"""
+单个目标的预算：墙钟截止时间 + token/费用上限 + 按近期延迟分位数自适应的阶段超时。
+
+每个阶段（observe / think / act / verify）开始前调用 budget.check(stage)，
+超限时抛出 BudgetExceeded，主循环捕获后带着部分结果干净退出。
+模型请求的超时取 min(近期 p95 × 系数, 剩余时间)，避免一次卡死的请求拖住整台设备。
+
+环境变量:
+  GOAL_DEADLINE_S      每个目标的墙钟上限（秒），默认 300
+  GOAL_MAX_TOKENS      每个目标的 token 上限（输入+输出），默认 0 = 不限，由费用上限约束
+                       （gpt-4o-mini 的图片按 token 计费很高，一次调用约 1.5 万 token，固定 token 上限会过早中止）
+  GOAL_MAX_COST_USD    每个目标的费用上限，默认 0.5
+  GOAL_BUDGET_LOG      每个目标结束时追加一行 JSON 的日志文件，默认 runs/goal_budget.jsonl
+"""
+import os, json, time, threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from pricing import estimate_cost
+
+GOAL_DEADLINE_S = float(os.getenv("GOAL_DEADLINE_S", "300"))
+GOAL_MAX_TOKENS = int(os.getenv("GOAL_MAX_TOKENS", "0"))
+GOAL_MAX_COST_USD = float(os.getenv("GOAL_MAX_COST_USD", "0.5"))
+GOAL_BUDGET_LOG = os.getenv("GOAL_BUDGET_LOG", os.path.join("runs", "goal_budget.jsonl"))
+
+# 样本不足时的默认超时（秒），以及自适应超时的上下限
+DEFAULT_STAGE_TIMEOUT_S = {"observe": 15.0, "think": 45.0, "verify": 45.0, "act": 15.0}
+TIMEOUT_FACTOR = 2.0
+TIMEOUT_MIN_S, TIMEOUT_MAX_S = 3.0, 90.0
+_MIN_SAMPLES = 5
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, stage: str, reason: str):
+        super().__init__(f"{stage}: {reason}")
+        self.stage = stage
+        self.reason = reason
+
+
+class LatencyTracker:
+    """按阶段保存最近的耗时，给出基于 p95 的超时"""
+
+    def __init__(self, window: int = 50):
+        self._lat = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._lat.setdefault(stage, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, stage: str, q: float) -> Optional[float]:
+        with self._lock:
+            v = sorted(self._lat.get(stage, ()))
+        if len(v) < _MIN_SAMPLES:
+            return None
+        return v[min(len(v) - 1, int(round(q / 100.0 * (len(v) - 1))))]
+
+    def timeout_for(self, stage: str) -> float:
+        p95 = self.percentile(stage, 95)
+        if p95 is None:
+            return DEFAULT_STAGE_TIMEOUT_S.get(stage, 30.0)
+        return max(TIMEOUT_MIN_S, min(TIMEOUT_MAX_S, p95 * TIMEOUT_FACTOR))
+
+
+# 进程内共享：同一台设备上连续跑多个目标时，分位数持续积累
+LATENCY = LatencyTracker()
+
+
+class GoalBudget:
+    def __init__(self, goal: str, deadline_s: float = GOAL_DEADLINE_S, max_tokens: int = GOAL_MAX_TOKENS,
+                 max_cost_usd: float = GOAL_MAX_COST_USD, tracker: LatencyTracker = LATENCY):
+        self.goal = goal
+        self.deadline_s = deadline_s
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+        self.tracker = tracker
+        self.started = time.time()
+        self._t0 = time.monotonic()
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.cost_usd = 0.0
+        self.calls = 0
+        self.stage_seconds = {}
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._t0
+
+    def remaining(self) -> float:
+        return self.deadline_s - self.elapsed()
+
+    def check(self, stage: str):
+        if self.remaining() <= 0:
+            raise BudgetExceeded(stage, f"deadline {self.deadline_s:.0f}s exceeded")
+        if self.max_tokens and self.tokens_in + self.tokens_out >= self.max_tokens:
+            raise BudgetExceeded(stage, f"token budget {self.max_tokens} exhausted")
+        if self.cost_usd >= self.max_cost_usd:
+            raise BudgetExceeded(stage, f"cost budget ${self.max_cost_usd:.2f} exhausted")
+
+    def timeout_for(self, stage: str) -> float:
+        """阶段超时：近期分位数给出的值，但不超过剩余时间"""
+        return max(0.5, min(self.tracker.timeout_for(stage), self.remaining()))
+
+    def record_usage(self, model: str, tokens_in: int, tokens_out: int):
+        self.calls += 1
+        self.tokens_in += int(tokens_in or 0)
+        self.tokens_out += int(tokens_out or 0)
+        self.cost_usd += estimate_cost(model, tokens_in or 0, tokens_out or 0)
+
+    def observe(self, stage: str, seconds: float):
+        self.tracker.record(stage, seconds)
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str):
+        """with budget.stage("think"): ... —— 先检查预算，再记录耗时"""
+        self.check(stage)
+        t0 = time.monotonic()
+        try:
+            yield self.timeout_for(stage)
+        finally:
+            self.observe(stage, time.monotonic() - t0)
+
+    def finish(self, status: str, reason: str = "", **extra) -> Dict[str, Any]:
+        """结束时汇总（部分）结果，追加到 GOAL_BUDGET_LOG 并返回"""
+        summary = {
+            "goal": self.goal,
+            "status": status,
+            "reason": reason,
+            "started_at": int(self.started),
+            "elapsed_s": round(self.elapsed(), 2),
+            "deadline_s": self.deadline_s,
+            "calls": self.calls,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "max_tokens": self.max_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            "max_cost_usd": self.max_cost_usd,
+            "stage_seconds": {k: round(v, 2) for k, v in self.stage_seconds.items()},
+        }
+        summary.update(extra)
+        print("[BUDGET]", json.dumps(summary, ensure_ascii=False))
+        if GOAL_BUDGET_LOG:
+            os.makedirs(os.path.dirname(GOAL_BUDGET_LOG) or ".", exist_ok=True)
+            with open(GOAL_BUDGET_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+        return summary
+
+
+def run_with_timeout(fn, timeout: float, *args, **kwargs):
+    """
+    在守护线程里执行没有超时参数的阻塞调用（如 MultiModalConversation.call）。
+    超时抛 TimeoutError；卡住的线程留在后台，不再阻塞主循环。
+    """
+    box = {}
+
+    def target():
+        try:
+            box["value"] = fn(*args, **kwargs)
+        except BaseException as e:
+            box["error"] = e
+
+    th = threading.Thread(target=target, daemon=True)
+    th.start()
+    th.join(timeout)
+    if th.is_alive():
+        raise TimeoutError(f"{getattr(fn, '__name__', fn)} timed out after {timeout:.1f}s")
+    if "error" in box:
+        raise box["error"]
+    return box.get("value")
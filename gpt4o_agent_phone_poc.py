@@ -4,6 +4,13 @@ from PIL import Image
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from app_index import try_direct_launch
+from screen_search import adb_scroll_find
+from device_state import get_adb_state, png_size
+from gesture_macro import MacroError, run_macro, run_shell_script, text_commands
+from goal_budget import GoalBudget, BudgetExceeded
+from prompt_compiler import PromptCompiler
+
 load_dotenv()
 
 # ---------- 配置 ----------
@@ -33,13 +40,15 @@ No markdown fences, no extra text outside JSON.
 # Action schema (STRICT JSON)
 Return exactly this schema with only the keys needed for the chosen action:
 {
-  "action": "tap|long_tap|swipe|type|back|home|keyevent|wait|done|fail",
+  "action": "tap|long_tap|swipe|type|find|macro|back|home|keyevent|wait|done|fail",
   "bbox": [x,y,w,h],          // required for tap/long_tap/type when targeting a UI element (absolute pixels on the given screenshot)
   "tap_point": [x,y],         // optional alternative to bbox when a point is clearer than a box
   "swipe": "up|down|left|right",  // required for swipe
-  "text": "string",           // required for type (ASCII; spaces OK)
+  "text": "string",           // required for type (any language; spaces OK) and find (visible label to look for)
   "keycode": 3|4|66|67,       // required for keyevent (examples: 3=HOME, 4=BACK, 66=ENTER, 67=DEL)
   "wait_ms": 300-2000,        // optional: if UI needs time to settle
+  "steps": [{"op":"tap","bbox":[x,y,w,h]}, {"op":"text","text":"..."}, {"op":"keyevent","keycode":66}],
+                              // required for macro: ≤20 ops of tap|long_tap|text|keyevent|swipe|wait, run in one device call
   "reason": "≤120 chars concise why this action helps", // keep short; no step lists
   "confidence": 0-100         // self-estimate of decision quality
 }
@@ -54,8 +63,11 @@ Return exactly this schema with only the keys needed for the chosen action:
   2) If a permission/security dialog blocks progress (e.g., “允许/Allow”, “同意/Agree”, “确定/OK”), tap the safest allow/continue variant when it clearly unblocks the flow. Avoid destructive options (wipe/reset).
   3) Prefer clear, labeled controls that advance toward the goal (e.g., “搜索/Search”, “设置/Settings”, magnifier icon).
   4) If the target app/icon isn’t visible on home, try a single swipe: usually "swipe":"up" to open the app drawer; else swipe left/right on paged launchers.
-  5) To enter text, pick the visible search/input field bbox and use {"action":"type","text":"..."} (keep short, no quotes/emoji).
+  5) To enter text, pick the visible search/input field bbox and use {"action":"type","text":"..."} (keep short, no emoji).
+     For tap field → type → ENTER on the current screen, use one {"action":"macro","steps":[...]} instead.
   6) If you reach an unexpected page, try {"action":"back"} once; if still blocked, try a directional {"action":"swipe"}.
+  7) If the target item is in a long scrollable list (settings, app drawer) but not visible yet, use
+     {"action":"find","text":"<label>","swipe":"up"} — it scrolls locally until the label appears, then taps it.
 - Make only ONE action per decision. Keep a steady, safe progression.
 
 # Hazards to avoid
@@ -93,14 +105,17 @@ Guidance:
 - No code fences, no extra text.
 """
 
+# think / verify 共用一个稳定前缀，SYS_PROMPT 只发一次（之前 system 和 user 里各一份）
+PROMPTS = PromptCompiler(SYS_PROMPT, VERIFY_PROMPT, "gpt-4o-mini")
+
 # ---------- adb 工具 ----------
 ADB_DIR = os.getenv("ADB_DIR")
 if ADB_DIR and os.path.isdir(ADB_DIR) and ADB_DIR not in os.environ.get("PATH", ""):
     os.environ["PATH"] = ADB_DIR + os.pathsep + os.environ.get("PATH", "")
 
 
-def run(cmd):
-    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+def run(cmd, timeout=None):
+    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=timeout)
     if cp.returncode != 0:
         raise RuntimeError(f"cmd failed: {' '.join(cmd)}\n{cp.stdout}")
     return cp.stdout
@@ -110,13 +125,13 @@ def adb_connect(host_port: str):
     return run(["adb", "connect", host_port])
 
 
-def adb_screencap(host_port: str) -> bytes:
-    out = subprocess.check_output(["adb", "-s", host_port, "exec-out", "screencap", "-p"])
+def adb_screencap(host_port: str, timeout=None) -> bytes:
+    out = subprocess.check_output(["adb", "-s", host_port, "exec-out", "screencap", "-p"], timeout=timeout)
     return out
 
 
-def adb_input(host_port: str, cmd: list):
-    return run(["adb", "-s", host_port, "shell", "input"] + cmd)
+def adb_input(host_port: str, cmd: list, timeout=None):
+    return run(["adb", "-s", host_port, "shell", "input"] + cmd, timeout=timeout)
 
 
 # ---------- 图像工具 ----------
@@ -143,53 +158,82 @@ def _force_parse_json(text: str) -> dict:
 
 
 # ---------- OpenAI 调用 ----------
-def call_openai(prompt_text: str, img_png: bytes) -> dict:
+def call_openai(goal: str, img_png: bytes, mode: str = "act", budget: GoalBudget = None) -> dict:
     assert OPENAI_API_KEY, "请先设置 OPENAI_API_KEY"
-    data_url = _png_to_jpeg_dataurl(img_png)
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",  # 可改成 gpt-4o
-        temperature=0,
-        messages=[
-            {"role": "system", "content": SYS_PROMPT},
-            {"role": "user", "content": [
-                {"type": "text", "text": prompt_text},
-                {"type": "image_url", "image_url": {"url": data_url}}
-            ]}
-        ]
-    )
+    stage = "verify" if mode == "verify" else "think"
+    req = PROMPTS.compile(goal, mode, png_size(img_png) or Image.open(io.BytesIO(img_png)).size)
+    data_url = _png_to_jpeg_dataurl(img_png, max_side=req["max_side"])
+    api = client
+    if budget:
+        budget.check(stage)
+        # 超时取近期延迟分位数与剩余时间的较小值；不自动重试，超时交给主循环处理
+        api = client.with_options(timeout=budget.timeout_for(stage), max_retries=0)
+    t0 = time.monotonic()
+    try:
+        resp = api.chat.completions.create(
+            model=PROMPTS.model,  # 可改成 gpt-4o
+            temperature=0,
+            messages=[
+                {"role": "system", "content": req["system"]},
+                {"role": "user", "content": [
+                    {"type": "text", "text": req["user_text"]},
+                    {"type": "image_url", "image_url": {"url": data_url, "detail": req["detail"]}}
+                ]}
+            ]
+        )
+    finally:
+        if budget:
+            budget.observe(stage, time.monotonic() - t0)
+    if resp.usage:
+        details = getattr(resp.usage, "prompt_tokens_details", None)
+        PROMPTS.report(req, mode, resp.usage.prompt_tokens, getattr(details, "cached_tokens", None))
+        if budget:
+            budget.record_usage(PROMPTS.model, resp.usage.prompt_tokens, resp.usage.completion_tokens)
     text = resp.choices[0].message.content
-    print
     return _force_parse_json(text)
 
 
 # ---------- 高层逻辑 ----------
-def think_action(goal: str, screenshot: bytes) -> Dict[str, Any]:
-    prompt = f"{SYS_PROMPT}\n\nGoal: {goal}\nReturn JSON only."
-    return call_openai(prompt, screenshot)
+def think_action(goal: str, screenshot: bytes, budget: GoalBudget = None) -> Dict[str, Any]:
+    return call_openai(goal, screenshot, "act", budget)
 
 
-def verify_progress(goal: str, screenshot: bytes) -> Dict[str, Any]:
-    prompt = f"{VERIFY_PROMPT}\n\nGoal: {goal}\nReturn JSON only."
-    return call_openai(prompt, screenshot)
+def verify_progress(goal: str, screenshot: bytes, budget: GoalBudget = None) -> Dict[str, Any]:
+    return call_openai(goal, screenshot, "verify", budget)
 
 
-def act(host_port: str, action: Dict[str, Any]):
+def act(host_port: str, action: Dict[str, Any], timeout: float = None):
+    """timeout: 本步 act 阶段的超时，传给每个 adb 调用"""
     a = action.get("action")
     if a == "tap":
         x, y = action["bbox"][:2]
-        adb_input(host_port, ["tap", str(x), str(y)])
+        adb_input(host_port, ["tap", str(x), str(y)], timeout)
     elif a == "swipe":
-        direction = action.get("swipe", "up")
-        if direction == "up":
-            adb_input(host_port, ["swipe", "300", "800", "300", "200", "300"])
-        elif direction == "down":
-            adb_input(host_port, ["swipe", "300", "200", "300", "800", "300"])
-        elif direction == "left":
-            adb_input(host_port, ["swipe", "600", "400", "100", "400", "300"])
-        elif direction == "right":
-            adb_input(host_port, ["swipe", "100", "400", "600", "400", "300"])
+        # 按缓存的真实屏幕尺寸计算滑动坐标
+        x0, y0, x1, y1 = get_adb_state(host_port).swipe_points(action.get("swipe", "up"))
+        adb_input(host_port, ["swipe", str(x0), str(y0), str(x1), str(y1), "300"], timeout)
+    elif a == "type" and not action.get("text"):
+        print("[WARN] type without text, skipped:", action)
     elif a == "type":
-        adb_input(host_port, ["text", action["text"]])
+        # 正确转义空格/引号，非 ASCII 走 Unicode 输入通道
+        run_shell_script(host_port, text_commands(action["text"]), timeout=timeout or 30)
+    elif a == "macro":
+        def resolve(step):
+            if "bbox" in step:
+                x, y, w, h = step["bbox"]
+                return {"tap_px": (int(x + w / 2), int(y + h / 2))}
+            if "tap_point" in step:
+                return {"tap_px": tuple(int(v) for v in step["tap_point"])}
+            return {}
+        run_macro(host_port, action.get("steps", []), resolve, get_adb_state(host_port).size, timeout=timeout or 30)
+    elif a == "find" and not action.get("text", "").strip():
+        print("[WARN] find without text, skipped:", action)
+    elif a == "find":
+        bbox = adb_scroll_find(host_port, action.get("text", ""), action.get("swipe", "up"),
+                               size=get_adb_state(host_port).size, timeout=timeout)
+        if bbox and action.get("tap", True):
+            x, y, w, h = bbox
+            adb_input(host_port, ["tap", str(x + w // 2), str(y + h // 2)], timeout)
     else:
         print("Unknown action:", action)
 
@@ -199,33 +243,66 @@ def main():
     host_port = os.getenv("ADB_HOST_PORT", "127.0.0.1:7555")
     goal = os.getenv("AGENT_GOAL", "Click home")
     MAX_STEPS = os.getenv("MAX_STEPS", "10")
+    # 截止时间 / 费用预算，每个阶段开始前检查；模型调用和 adb 调用都按阶段超时
+    budget = GoalBudget(goal)
+    status, reason, _no_step = "max_steps", "", -1
 
     adb_connect(host_port)
-
-    for _no_step in range(int(MAX_STEPS)):
-        print(f"[STEP {_no_step}] observe & think")
-        screenshot = adb_screencap(host_port)
-        try:
-            action = think_action(goal, screenshot)
-            print("Action instructed by AI Brain:", action)
-        except Exception as e:
-            print("[ERROR] think failed:", e)
-            break
-
-        act(host_port, action)
-        time.sleep(2)
-
-        print(f"[STEP {_no_step}] verify")
-        screenshot = adb_screencap(host_port)
-        try:
-            result = verify_progress(goal, screenshot)
-            print("Verify:", result)
-            if result.get("status") == "done":
-                print("Goal achieved ✅")
-                break
-        except Exception as e:
-            print("[ERROR] verify failed:", e)
-            break
+    try:
+        if try_direct_launch(host_port, goal) == "done":
+            print("Goal achieved ✅ (direct launch)")
+            status, reason = "done", "direct launch"
+        else:
+            for _no_step in range(int(MAX_STEPS)):
+                print(f"[STEP {_no_step}] observe & think")
+                with budget.stage("observe") as timeout:
+                    screenshot = adb_screencap(host_port, timeout=timeout)
+                get_adb_state(host_port).observe_frame(screenshot)
+                try:
+                    action = think_action(goal, screenshot, budget)
+                    print("Action instructed by AI Brain:", action)
+                except BudgetExceeded:
+                    raise
+                except Exception as e:
+                    print("[ERROR] think failed:", e)
+                    status, reason = "error", f"think failed: {e}"
+                    break
+
+                with budget.stage("act") as timeout:
+                    try:
+                        act(host_port, action, timeout)
+                    except MacroError as e:
+                        # 宏 / 文本输入不合法或执行失败：这一步作废，重新观察
+                        print("[ERROR] act failed:", e)
+                        continue
+                time.sleep(2)
+
+                print(f"[STEP {_no_step}] verify")
+                with budget.stage("observe") as timeout:
+                    screenshot = adb_screencap(host_port, timeout=timeout)
+                try:
+                    result = verify_progress(goal, screenshot, budget)
+                    print("Verify:", result)
+                    if result.get("status") == "done":
+                        print("Goal achieved ✅")
+                        status = "done"
+                        break
+                except BudgetExceeded:
+                    raise
+                except Exception as e:
+                    print("[ERROR] verify failed:", e)
+                    status, reason = "error", f"verify failed: {e}"
+                    break
+    except BudgetExceeded as e:
+        print("[ABORT] budget exceeded:", e)
+        status, reason = "aborted", str(e)
+    except subprocess.TimeoutExpired as e:
+        print("[ABORT] adb timed out:", e)
+        status, reason = "aborted", f"adb timeout: {e}"
+    except Exception as e:
+        print("[ERROR] run failed:", e)
+        status, reason = "error", f"{type(e).__name__}: {e}"
+    return budget.finish(status, reason, steps=_no_step + 1)
 
 
 if __name__ == "__main__":
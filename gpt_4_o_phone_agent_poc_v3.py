@@ -1,23 +1,38 @@
-import os, io, re, json, base64, subprocess, time
+import os, io, subprocess, time
 from typing import Dict, Any
 from PIL import Image
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from app_index import try_direct_launch
+from screen_search import adb_scroll_find
+from template_match import known_target_bbox
+from goal_budget import GoalBudget, BudgetExceeded
+from trace_archive import TraceArchive
+from device_state import get_adb_state, png_size, swipe_points
+from gesture_macro import MacroError, run_macro, run_shell_script, text_commands
+from prompt_compiler import PromptCompiler, estimate_image_tokens
+import frame_diff
+from model_io import (
+    load_prompt, png_to_jpeg_dataurl_and_sizes, center_of_bbox, map_action_coords_to_device, force_parse_json,
+)
+
 load_dotenv()
 
 # ---------- 配置 ----------
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-def load_prompt(filename: str) -> str:
-    """Load prompt from prompts directory"""
-    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", filename)
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return f.read().strip()
+client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None  # 无 key 时允许被离线工具 import
 
 SYS_PROMPT = load_prompt("system_prompt.txt")
 VERIFY_PROMPT = load_prompt("verify_prompt.txt")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # 或 gpt-4o
+# think / verify 共用一个稳定前缀（system + verify + goal），便于服务端 prompt 缓存命中
+PROMPTS = PromptCompiler(SYS_PROMPT, VERIFY_PROMPT, OPENAI_MODEL)
+
+# 设置 TRACE_ARCHIVE_DIR 后，每次模型调用的截图 / prompt / 原始回复由后台线程归档（见 trace_archive.py）
+TRACE_ARCHIVE_DIR = os.getenv("TRACE_ARCHIVE_DIR")
+_trace_run = None  # 当前运行的 TraceRun
+_trace_step = 0  # 当前步号，归档记录用
 
 # ---------- adb 工具 ----------
 ADB_DIR = os.getenv("ADB_DIR")
@@ -25,8 +40,8 @@ if ADB_DIR and os.path.isdir(ADB_DIR) and ADB_DIR not in os.environ.get("PATH",
     os.environ["PATH"] = ADB_DIR + os.pathsep + os.environ.get("PATH", "")
 
 
-def run(cmd):
-    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+def run(cmd, timeout=None):
+    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=timeout)
     if cp.returncode != 0:
         raise RuntimeError(f"cmd failed: {' '.join(cmd)}\n{cp.stdout}")
     return cp.stdout
@@ -36,86 +51,15 @@ def adb_connect(host_port: str):
     return run(["adb", "connect", host_port])
 
 
-def adb_screencap(host_port: str) -> bytes:
-    return subprocess.check_output(["adb", "-s", host_port, "exec-out", "screencap", "-p"])
-
+def adb_screencap(host_port: str, timeout=None) -> bytes:
+    return subprocess.check_output(["adb", "-s", host_port, "exec-out", "screencap", "-p"], timeout=timeout)
 
-def adb_input(host_port: str, cmd: list):
-    return run(["adb", "-s", host_port, "shell", "input"] + cmd)
 
-
-# ---------- 图像工具 ----------
-def png_to_jpeg_dataurl_and_sizes(png_bytes, max_side=1024, quality=85):
-    src = Image.open(io.BytesIO(png_bytes)).convert("RGB")
-    W, H = src.size
-    s = min(1.0, max_side / max(W, H))
-    if s < 1.0:
-        dst = src.resize((int(W * s), int(H * s)))
-    else:
-        dst = src
-    buf = io.BytesIO();
-    dst.save(buf, format="JPEG", quality=quality, optimize=True)
-    data_url = "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
-    return data_url, (W, H), dst.size
-
-
-def denorm_point(norm_xy, W, H):
-    x = int(round(float(norm_xy[0]) * W))
-    y = int(round(float(norm_xy[1]) * H))
-    return x, y
-
-
-def denorm_bbox(norm_xyxy, W, H):
-    x0 = int(round(float(norm_xyxy[0]) * W))
-    y0 = int(round(float(float(norm_xyxy[1]) * H)))
-    x1 = int(round(float(norm_xyxy[2]) * W))
-    y1 = int(round(float(norm_xyxy[3]) * H))
-    w, h = max(1, x1 - x0), max(1, y1 - y0)
-    return [x0, y0, w, h]
-
-
-def center_of_bbox(b):
-    x, y, w, h = b
-    return int(x + w / 2), int(y + h / 2)
-
-
-def map_action_coords_to_device(action: dict, orig_size, res_size):
-    W, H = orig_size;
-    w_res, h_res = res_size
-    sx, sy = W / float(w_res), H / float(h_res)
-
-    # ---- tap / long_tap mapping ----
-    if "norm_point" in action:
-        return {"tap_px": denorm_point(action["norm_point"], W, H)}
-    if "norm_bbox" in action:
-        b = denorm_bbox(action["norm_bbox"], W, H)
-        return {"tap_px": center_of_bbox(b), "bbox_px": b}
-    if "tap_point" in action:
-        rx, ry = action["tap_point"]
-        return {"tap_px": (int(round(rx * sx)), int(round(ry * sy)))}
-    if "bbox" in action:
-        x, y, w, h = action["bbox"]
-        b = [int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy))]
-        return {"tap_px": center_of_bbox(b), "bbox_px": b}
-
-    # ---- swipe mapping (optional points) ----
-    swipe_from = swipe_to = None
-    if "swipe_norm_from" in action and "swipe_norm_to" in action:
-        swipe_from = denorm_point(action["swipe_norm_from"], W, H)
-        swipe_to = denorm_point(action["swipe_norm_to"], W, H)
-    elif "swipe_px_from" in action and "swipe_px_to" in action:
-        fx, fy = action["swipe_px_from"];
-        tx, ty = action["swipe_px_to"]
-        swipe_from = (int(round(fx * sx)), int(round(fy * sy)))
-        swipe_to = (int(round(tx * sx)), int(round(ty * sy)))
-
-    out = {}
-    if swipe_from and swipe_to:
-        out["swipe_from_px"] = swipe_from
-        out["swipe_to_px"] = swipe_to
-    return out
+def adb_input(host_port: str, cmd: list, timeout=None):
+    return run(["adb", "-s", host_port, "shell", "input"] + cmd, timeout=timeout)
 
 
+# ---------- 策略 ----------
 HOME_GUARD_WINDOW = 1  # 只有在“上一次动作是 HOME”的接下来 1 步内，才允许 swipe
 _last_home_step = -999  # 记录最近执行 HOME 的步号
 
@@ -147,47 +91,86 @@ def enforce_home_first(proposed: dict, step: int) -> dict:
 
 
 # ---------- OpenAI 调用 ----------
-def _force_parse_json(text: str) -> dict:
-    t = text.strip()
-    t = re.sub(r"^```(?:json)?\\s*|\\s*```$", "", t, flags=re.I | re.S).strip()
-    try:
-        return json.loads(t)
-    except:
-        m = re.search(r"\{[\s\S]*\}", t)
-        if m:
-            return json.loads(m.group(0))
-        raise ValueError(f"Model did not return JSON. preview={t[:200]}")
-
-
-def call_openai(prompt_text: str, img_png: bytes) -> dict:
+def call_openai(goal: str, img_png: bytes, budget: GoalBudget = None, stage: str = "think",
+                diff: dict = None, req: dict = None) -> dict:
+    """diff: frame_diff.diff_frames 的结果；kind=crop 时只发缩略图 + 变化区域裁剪。
+    req: 调用方已编译好的整帧 prompt（无 diff 时复用，不再编译一次）"""
     assert OPENAI_API_KEY, "请先设置 OPENAI_API_KEY"
-    data_url, orig_size, res_size = png_to_jpeg_dataurl_and_sizes(img_png)
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",  # 或 gpt-4o
-        temperature=0,
-        messages=[
-            {"role": "system", "content": SYS_PROMPT},
-            {"role": "user", "content": [
-                {"type": "text",
-                 "text": f"Goal: {prompt_text} (orig={orig_size}, resized={res_size}). Return JSON only."},
-                {"type": "image_url", "image_url": {"url": data_url}}
-            ]}
-        ]
-    )
+    model = OPENAI_MODEL
+    mode = "verify" if stage == "verify" else "act"
+    if diff and diff["kind"] == "crop":
+        req = PROMPTS.compile(goal, mode, frame_diff.crop_size(diff), note=frame_diff.crop_note(diff),
+                              extra_images=[frame_diff.thumb_size(diff)])
+        images = frame_diff.crop_images(diff, req["max_side"])
+        image_parts = [{"type": "image_url", "image_url": {"url": im["data_url"], "detail": d}}
+                       for im, d in zip(images, ("low", req["detail"]))]
+    else:
+        if diff:
+            # 差分时已经解码过整帧，直接复用
+            req = PROMPTS.compile(goal, mode, diff["size"])
+            images = [frame_diff.full_image(diff, req["max_side"])]
+        else:
+            req = req or PROMPTS.compile(goal, mode, png_size(img_png) or Image.open(io.BytesIO(img_png)).size)
+            data_url, orig_size, res_size = png_to_jpeg_dataurl_and_sizes(img_png, max_side=req["max_side"])
+            images = [{"data_url": data_url, "bytes": len(data_url.split(",", 1)[1]) * 3 // 4, "size": res_size}]
+        frame_diff.STATS.observe_full(images[0]["bytes"], images[0]["size"])
+        image_parts = [{"type": "image_url", "image_url": {"url": images[0]["data_url"], "detail": req["detail"]}}]
+    api = client
+    if budget:
+        budget.check(stage)
+        # 超时取近期延迟分位数与剩余时间的较小值；不自动重试，超时交给主循环处理
+        api = client.with_options(timeout=budget.timeout_for(stage), max_retries=0)
+    t0 = time.monotonic()
+    try:
+        resp = api.chat.completions.create(
+            model=model,
+            temperature=0,
+            messages=[
+                {"role": "system", "content": req["system"]},
+                {"role": "user", "content": [{"type": "text", "text": req["user_text"]}] + image_parts}
+            ]
+        )
+    finally:
+        latency = time.monotonic() - t0
+        if budget:
+            budget.observe(stage, latency)
+    if diff:
+        sent_bytes = sum(im["bytes"] for im in images)
+        sent_tokens = (frame_diff.image_tokens(images, model, req["detail"]) if diff["kind"] == "crop"
+                       else estimate_image_tokens(images[0]["size"], model, req["detail"]))
+        frame_diff.STATS.record(diff, model, sent_bytes, sent_tokens, latency)
+    usage = resp.usage
+    if usage:
+        details = getattr(usage, "prompt_tokens_details", None)
+        PROMPTS.report(req, mode, usage.prompt_tokens, getattr(details, "cached_tokens", None))
+        if budget:
+            budget.record_usage(model, usage.prompt_tokens, usage.completion_tokens)
     text = resp.choices[0].message.content
-    return _force_parse_json(text)
+    if _trace_run:
+        _trace_run.log(_trace_step, stage, frame=img_png, prompt=req["system"], response=text,
+                       user_text=req["user_text"], model=model, payload=diff["kind"] if diff else "full")
+    return force_parse_json(text)
 
 
 # ---------- 高层逻辑 ----------
-def think_action(goal: str, screenshot: bytes) -> Dict[str, Any]:
-    return call_openai(goal, screenshot)
+def think_action(goal: str, screenshot: bytes, budget: GoalBudget = None, req: dict = None) -> Dict[str, Any]:
+    return call_openai(goal, screenshot, budget, "think", req=req)
 
 
-def verify_progress(goal: str, screenshot: bytes) -> Dict[str, Any]:
-    return call_openai(f"{VERIFY_PROMPT}\nGoal: {goal}", screenshot)
+def verify_progress(goal: str, screenshot: bytes, budget: GoalBudget = None, pre_frame: bytes = None) -> Dict[str, Any]:
+    """给了动作前的截图时先做差分：没变化直接返回 skipped，变化小只发裁剪"""
+    if pre_frame is None:
+        return call_openai(goal, screenshot, budget, "verify")
+    diff = frame_diff.diff_frames(pre_frame, screenshot, OPENAI_MODEL)
+    print(f"[DIFF] {diff['kind']} changed={diff['changed_frac']} regions={len(diff['regions'])} ({diff['diff_ms']}ms)")
+    if diff["kind"] == "skip":
+        frame_diff.STATS.record(diff, OPENAI_MODEL)
+        return {"status": "not_done", "skipped": True, "hint": "screen did not change after the last action"}
+    return call_openai(goal, screenshot, budget, "verify", diff)
 
 
-def act(host_port: str, action: Dict[str, Any], orig_size, res_size):
+def act(host_port: str, action: Dict[str, Any], orig_size, res_size, timeout: float = None):
+    """timeout: 本步 act 阶段的超时（budget.stage 给出），传给每个 adb 调用；find 按它限制总时长"""
     a = action.get("action")
     mapped = map_action_coords_to_device(action, orig_size, res_size)
 
@@ -195,38 +178,53 @@ def act(host_port: str, action: Dict[str, Any], orig_size, res_size):
         x, y = mapped["tap_px"]
         if a == "long_tap":
             # 长按：按住 500ms（部分 ROM 需要更长可调）
-            adb_input(host_port, ["swipe", str(x), str(y), str(x), str(y), "500"])
+            adb_input(host_port, ["swipe", str(x), str(y), str(x), str(y), "500"], timeout)
         else:
-            adb_input(host_port, ["tap", str(x), str(y)])
+            adb_input(host_port, ["tap", str(x), str(y)], timeout)
 
     elif a == "swipe":
         # 优先使用坐标化滑动；否则用方向滑动回退
         if "swipe_from_px" in mapped and "swipe_to_px" in mapped:
             x0, y0 = mapped["swipe_from_px"]
             x1, y1 = mapped["swipe_to_px"]
-            adb_input(host_port, ["swipe", str(x0), str(y0), str(x1), str(y1), "300"])
+            adb_input(host_port, ["swipe", str(x0), str(y0), str(x1), str(y1), "300"], timeout)
         else:
-            direction = action.get("swipe", "up")
-            if direction == "up":
-                adb_input(host_port, ["swipe", "300", "800", "300", "200", "300"])
-            elif direction == "down":
-                adb_input(host_port, ["swipe", "300", "200", "300", "800", "300"])
-            elif direction == "left":
-                adb_input(host_port, ["swipe", "600", "400", "100", "400", "300"])
-            elif direction == "right":
-                adb_input(host_port, ["swipe", "100", "400", "600", "400", "300"])
+            # 方向滑动按真实屏幕尺寸取比例坐标（orig_size 来自设备状态缓存）
+            x0, y0, x1, y1 = swipe_points(action.get("swipe", "up"), *orig_size)
+            adb_input(host_port, ["swipe", str(x0), str(y0), str(x1), str(y1), "300"], timeout)
+
+    elif a == "type" and not action.get("text"):
+        print("[WARN] type without text, skipped:", action)
 
     elif a == "type":
-        adb_input(host_port, ["text", action["text"]])
+        # 空格/引号正确转义；非 ASCII 文本走 Unicode 输入通道
+        run_shell_script(host_port, text_commands(action["text"]), timeout=timeout or 30)
+
+    elif a == "macro":
+        # 多个原语编译成一个 shell 脚本，一次 adb 往返；坐标与顶层动作同样映射
+        run_macro(host_port, action.get("steps", []),
+                  lambda step: map_action_coords_to_device(step, orig_size, res_size), orig_size,
+                  timeout=timeout or 30)
+
+    elif a == "find" and not action.get("text", "").strip():
+        print("[WARN] find without text, skipped:", action)
+
+    elif a == "find":
+        # 本地滚动查找，不再每次滑动都问模型；找到后默认点击
+        bbox = adb_scroll_find(host_port, action.get("text", ""), action.get("swipe", "up"), size=orig_size,
+                               timeout=timeout)
+        if bbox and action.get("tap", True):
+            x, y = center_of_bbox(bbox)
+            adb_input(host_port, ["tap", str(x), str(y)], timeout)
 
     elif a == "home":
-        adb_input(host_port, ["keyevent", "3"])
+        adb_input(host_port, ["keyevent", "3"], timeout)
 
     elif a == "back":
-        adb_input(host_port, ["keyevent", "4"])
+        adb_input(host_port, ["keyevent", "4"], timeout)
 
     elif a == "keyevent":
-        adb_input(host_port, ["keyevent", str(action["keycode"])])
+        adb_input(host_port, ["keyevent", str(action["keycode"])], timeout)
 
     elif a == "wait":
         time.sleep(int(action.get("wait_ms", 1000)) / 1000.0)
@@ -240,37 +238,133 @@ def act(host_port: str, action: Dict[str, Any], orig_size, res_size):
 
 # ---------- 主循环 ----------
 def main():
+    global _trace_run, _trace_step
     host_port = os.getenv("ADB_HOST_PORT", "127.0.0.1:7555")
     goal = os.getenv("AGENT_GOAL", "Open Settings app")
     MAX_STEPS = int(os.getenv("MAX_STEPS", "10"))
+    # 设置后把“被验证推进了进度”的动作录制为离线回放样本（见 replay_eval.py）
+    record_dir = os.getenv("REPLAY_RECORD_DIR")
+    best_progress = 0  # 只有把进度推高到 0 以上的动作才录为样本
+    last_template = None
+    # 截止时间 / token / 费用预算，每个阶段开始前检查
+    budget = GoalBudget(goal)
+    # 分辨率只探测一次，之后靠截图尺寸变化失效
+    state = get_adb_state(host_port)
+    status, reason, step = "max_steps", "", -1
+    archive = TraceArchive(TRACE_ARCHIVE_DIR) if TRACE_ARCHIVE_DIR else None
+    if archive:
+        _trace_run = archive.start_run(goal, device=host_port)
 
     adb_connect(host_port)
-    for step in range(MAX_STEPS):
-        print(f"[STEP {step}] observe & think")
-        screenshot = adb_screencap(host_port)
-        orig_size = Image.open(io.BytesIO(screenshot)).size
-
-        try:
-            action = call_openai(goal, screenshot)
-            print("Action:", action)
-        except Exception as e:
-            print("[ERROR] think failed:", e)
-            break
-
-        act(host_port, action, orig_size, (1024, int(1024 * orig_size[1] / max(orig_size))))
-        time.sleep(2)
-
-        print(f"[STEP {step}] verify")
-        screenshot = adb_screencap(host_port)
-        try:
-            result = verify_progress(goal, screenshot)
-            print("Verify:", result)
-            if result.get("status") == "done":
-                print("🎉 Goal completed!")
-                break
-        except Exception as e:
-            print("[ERROR] verify failed:", e)
-            break
+    try:
+        # “打开 X” 类目标先走应用索引直接启动；近似命中只启动应用，仍由视觉循环确认
+        if try_direct_launch(host_port, goal) == "done":
+            print("🎉 Goal completed! (direct launch)")
+            status, reason = "done", "direct launch"
+        else:
+            for step in range(MAX_STEPS):
+                print(f"[STEP {step}] observe & think")
+                _trace_step = step
+                with budget.stage("observe") as timeout:
+                    screenshot = adb_screencap(host_port, timeout=timeout)
+                think_frame = screenshot
+                orig_size = state.observe_frame(screenshot)
+                # 本步 act prompt 只编译一次：think 用它发图，res_size 是模型坐标所在的截图尺寸（超预算时会缩小）
+                req = PROMPTS.compile(goal, "act", orig_size)
+                res_size = req["res_size"]
+
+                try:
+                    # 已知目标先走本地模板匹配；同一模板不连续使用两次，避免点击无效时原地打转
+                    hit = known_target_bbox(goal, screenshot)
+                    if hit and hit["name"] != last_template:
+                        x, y, w, h = hit["bbox"]
+                        W, H = orig_size
+                        action = {"action": "tap", "norm_bbox": [x / W, y / H, (x + w) / W, (y + h) / H],
+                                  "reason": f"template match: {hit['name']}", "confidence": int(hit["confidence"] * 100)}
+                        last_template = hit["name"]
+                    else:
+                        action = think_action(goal, screenshot, budget, req)
+                        last_template = None
+                    print("Action:", action)
+                except BudgetExceeded:
+                    raise
+                except Exception as e:
+                    print("[ERROR] think failed:", e)
+                    status, reason = "error", f"think failed: {e}"
+                    break
+
+                act_error = None
+                with budget.stage("act") as timeout:
+                    try:
+                        act(host_port, action, orig_size, res_size, timeout)
+                    except MacroError as e:
+                        # 宏 / 文本输入不合法或执行失败：记为失败的一步，下一步重新观察
+                        print("[ERROR] act failed:", e)
+                        act_error = str(e)
+                state.invalidate_foreground()
+                if _trace_run:
+                    _trace_run.log(step, "act", action=action, error=act_error)
+                if act_error:
+                    continue
+                time.sleep(2)
+
+                print(f"[STEP {step}] verify")
+                with budget.stage("observe") as timeout:
+                    screenshot = adb_screencap(host_port, timeout=timeout)
+                state.observe_frame(screenshot)
+                try:
+                    # done 动作本身不改屏幕，必须照常验证；其余动作与动作前的截图做差分
+                    pre_frame = think_frame if action.get("action") != "done" else None
+                    result = verify_progress(goal, screenshot, budget, pre_frame)
+                    print("Verify:", result)
+                    if result.get("skipped"):
+                        # 屏幕没变：这一步无效，不录样本，直接进入下一步；归档里照样留一条 verify 记录
+                        if _trace_run:
+                            _trace_run.log(step, "verify", frame=screenshot, payload="skip", skipped=True,
+                                           hint=result.get("hint"))
+                        continue
+                    progress = int(result.get("progress", 0) or 0)
+                    if record_dir and (result.get("status") == "done" or progress > best_progress):
+                        from replay_eval import append_sample
+                        append_sample(record_dir, think_frame, goal, action, orig_size, res_size)
+                    best_progress = max(best_progress, progress)
+                    if result.get("status") == "done":
+                        print("🎉 Goal completed!")
+                        status = "done"
+                        break
+                except BudgetExceeded:
+                    raise
+                except Exception as e:
+                    print("[ERROR] verify failed:", e)
+                    status, reason = "error", f"verify failed: {e}"
+                    break
+    except BudgetExceeded as e:
+        print("[ABORT] budget exceeded:", e)
+        status, reason = "aborted", str(e)
+    except subprocess.TimeoutExpired as e:
+        print("[ABORT] adb timed out:", e)
+        status, reason = "aborted", f"adb timeout: {e}"
+    except Exception as e:
+        # 其它异常（adb 断开、归档出错等）也要落到 finish，保留预算用量和归档记录
+        print("[ERROR] run failed:", e)
+        status, reason = "error", f"{type(e).__name__}: {e}"
+
+    # 超限时也返回部分结果：已执行步数、最好进度、预算用量、verify 载荷对比
+    return _finish_run(archive, budget.finish(status, reason, steps=step + 1, progress=best_progress,
+                                              verify_payload=frame_diff.STATS.summary()))
+
+
+def _finish_run(archive, summary: dict) -> dict:
+    """关闭归档运行并等待后台写完（最多几秒），返回 summary"""
+    global _trace_run
+    if archive and _trace_run:
+        _trace_run.close(**summary)
+        archive.flush()
+        if archive.dropped:
+            print(f"[TRACE] dropped {archive.dropped} record(s): writer queue was full")
+        print("[TRACE] run:", _trace_run.run_id)
+        _trace_run = None
+    return summary
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+"""
+模型输入输出的纯函数工具：prompt 加载、截图编码、坐标映射、JSON 解析。
+
+不读环境变量、不建客户端，POC 和离线工具（replay_eval）都可以直接 import。
+"""
+import os, io, re, json, base64
+
+from PIL import Image
+
+
+# ---------- prompt ----------
+def load_prompt(filename: str) -> str:
+    """Load prompt from prompts directory"""
+    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", filename)
+    with open(prompt_path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+# ---------- 图像 / 坐标 ----------
+def png_to_jpeg_dataurl_and_sizes(png_bytes, max_side=1024, quality=85):
+    src = Image.open(io.BytesIO(png_bytes)).convert("RGB")
+    W, H = src.size
+    s = min(1.0, max_side / max(W, H))
+    if s < 1.0:
+        dst = src.resize((int(W * s), int(H * s)))
+    else:
+        dst = src
+    buf = io.BytesIO();
+    dst.save(buf, format="JPEG", quality=quality, optimize=True)
+    data_url = "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+    return data_url, (W, H), dst.size
+
+
+def denorm_point(norm_xy, W, H):
+    x = int(round(float(norm_xy[0]) * W))
+    y = int(round(float(norm_xy[1]) * H))
+    return x, y
+
+
+def denorm_bbox(norm_xyxy, W, H):
+    x0 = int(round(float(norm_xyxy[0]) * W))
+    y0 = int(round(float(float(norm_xyxy[1]) * H)))
+    x1 = int(round(float(norm_xyxy[2]) * W))
+    y1 = int(round(float(norm_xyxy[3]) * H))
+    w, h = max(1, x1 - x0), max(1, y1 - y0)
+    return [x0, y0, w, h]
+
+
+def center_of_bbox(b):
+    x, y, w, h = b
+    return int(x + w / 2), int(y + h / 2)
+
+
+def map_action_coords_to_device(action: dict, orig_size, res_size):
+    W, H = orig_size;
+    w_res, h_res = res_size
+    sx, sy = W / float(w_res), H / float(h_res)
+
+    # ---- tap / long_tap mapping ----
+    if "norm_point" in action:
+        return {"tap_px": denorm_point(action["norm_point"], W, H)}
+    if "norm_bbox" in action:
+        b = denorm_bbox(action["norm_bbox"], W, H)
+        return {"tap_px": center_of_bbox(b), "bbox_px": b}
+    if "tap_point" in action:
+        rx, ry = action["tap_point"]
+        return {"tap_px": (int(round(rx * sx)), int(round(ry * sy)))}
+    if "bbox" in action:
+        x, y, w, h = action["bbox"]
+        b = [int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy))]
+        return {"tap_px": center_of_bbox(b), "bbox_px": b}
+
+    # ---- swipe mapping (optional points) ----
+    swipe_from = swipe_to = None
+    if "swipe_norm_from" in action and "swipe_norm_to" in action:
+        swipe_from = denorm_point(action["swipe_norm_from"], W, H)
+        swipe_to = denorm_point(action["swipe_norm_to"], W, H)
+    elif "swipe_px_from" in action and "swipe_px_to" in action:
+        fx, fy = action["swipe_px_from"];
+        tx, ty = action["swipe_px_to"]
+        swipe_from = (int(round(fx * sx)), int(round(fy * sy)))
+        swipe_to = (int(round(tx * sx)), int(round(ty * sy)))
+
+    out = {}
+    if swipe_from and swipe_to:
+        out["swipe_from_px"] = swipe_from
+        out["swipe_to_px"] = swipe_to
+    return out
+
+
+# ---------- 解析 ----------
+def force_parse_json(text: str) -> dict:
+    t = text.strip()
+    t = re.sub(r"^```(?:json)?\\s*|\\s*```$", "", t, flags=re.I | re.S).strip()
+    try:
+        return json.loads(t)
+    except:
+        m = re.search(r"\{[\s\S]*\}", t)
+        if m:
+            return json.loads(m.group(0))
+        raise ValueError(f"Model did not return JSON. preview={t[:200]}")
@@ -0,0 +1,21 @@
+import os, json
+
+# ---------- 模型单价（USD / 1M tokens: 输入, 输出） ----------
+# 价格会变，可通过环境变量 MODEL_PRICES_JSON 覆盖，例如:
+#   MODEL_PRICES_JSON='{"gpt-4o-mini": [0.15, 0.6]}'
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "qwen-vl-plus": (0.21, 0.63),
+    "qwen-vl-max": (0.80, 3.20),
+}
+
+_override = os.getenv("MODEL_PRICES_JSON")
+if _override:
+    MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(_override).items()})
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    """按单价表估算一次调用的费用（USD），未知模型返回 0"""
+    p_in, p_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * p_in + output_tokens * p_out) / 1_000_000
@@ -0,0 +1,138 @@
+"""
+Prompt 编译：把 system / verify / goal 拼成字节级稳定的前缀，让服务端的 prompt 缓存能命中。
+
+布局（不变的放前面，会变的放后面）:
+  system 消息 = 规范化后的 system prompt + verify 说明 + 模式说明 + Goal   ← 同一目标内逐字节相同
+  user 消息   = "MODE: ACT|VERIFY" + 截图尺寸 + 截图                      ← 每步变化
+
+think 和 verify 共用同一个前缀，不再把 SYS_PROMPT 同时塞进 system 和 user。
+每次调用前按 PROMPT_TOKEN_BUDGET 估算 token：超了先缩小截图，再降到 low detail，
+文本前缀本身超预算直接报错。调用后打印估算 / 实际 / 命中缓存的 prompt token，方便发现回归。
+"""
+import os, re, math, hashlib
+from typing import Dict, Any, Optional, Sequence, Tuple
+
+from device_state import fit_size
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "40000"))
+IMAGE_SIDES = (1024, 768, 512)  # 超预算时依次尝试的截图长边
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+_MODE_TEXT = """# Modes
+Each request starts with MODE: ACT or MODE: VERIFY.
+- MODE: ACT → choose ONE next action and return only the action JSON described above.
+- MODE: VERIFY → ignore the action schema; follow the verifier instructions and return only the verification JSON."""
+
+
+# ---------- token 估算 ----------
+def estimate_text_tokens(text: str) -> int:
+    """粗估：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def estimate_image_tokens(size: Tuple[int, int], model: str, detail: str = "high") -> int:
+    w, h = size
+    if model.startswith("qwen"):
+        # Qwen-VL：每 28x28 像素块约 1 token
+        return math.ceil(w / 28) * math.ceil(h / 28) + 2
+    # OpenAI：缩放到 2048 内、短边 768 后按 512 切片；mini 的计费 token 数是 4o 的约 33 倍
+    base, per_tile = (2833, 5667) if "mini" in model else (85, 170)
+    if detail == "low":
+        return base
+    s = min(1.0, 2048.0 / max(w, h))
+    w, h = w * s, h * s
+    s = min(1.0, 768.0 / min(w, h))
+    w, h = w * s, h * s
+    return base + per_tile * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+# ---------- 规范化 ----------
+def normalize_section(text: str) -> str:
+    """去行尾空白、合并多余空行，保证相同内容得到相同字节"""
+    lines = [ln.rstrip() for ln in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+
+def dedup_lines(sections):
+    """跨段删除完全重复的长行（短行如 "{"、"}" 保留），返回新的段列表"""
+    seen, out = set(), []
+    for sec in sections:
+        kept = []
+        for ln in sec.splitlines():
+            key = ln.strip()
+            if len(key) > 20 and key in seen:
+                continue
+            seen.add(key)
+            kept.append(ln)
+        out.append("\n".join(kept))
+    return out
+
+
+class PromptCompiler:
+    def __init__(self, system_prompt: str, verify_prompt: str, model: str,
+                 max_tokens: int = PROMPT_TOKEN_BUDGET):
+        sys_sec, verify_sec = dedup_lines([normalize_section(system_prompt), normalize_section(verify_prompt)])
+        self.static_prefix = f"{sys_sec}\n\n# Verifier instructions (MODE: VERIFY)\n{verify_sec}\n\n{_MODE_TEXT}"
+        self.model = model
+        self.max_tokens = max_tokens
+        self._prefix_cache = {}
+        self.stats = {"calls": 0, "est_tokens": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    def system_text(self, goal: str) -> str:
+        """静态部分 + 目标；同一目标每次返回同一个字符串对象"""
+        if goal not in self._prefix_cache:
+            self._prefix_cache[goal] = f"{self.static_prefix}\n\n# Goal\n{normalize_section(goal)}"
+        return self._prefix_cache[goal]
+
+    def compile(self, goal: str, mode: str, orig_size: Tuple[int, int], note: str = "",
+                extra_images: Sequence[Tuple[int, int]] = ()) -> Dict[str, Any]:
+        """
+        mode: "act" / "verify"。返回 {system, user_text, max_side, detail, est_tokens, prefix_sha}，
+        调用方按 max_side 压缩截图、按 detail 设置图片参数。
+        extra_images: 额外的 low detail 小图（如 verify 的全屏缩略图），只计入预算，不参与缩放。
+        """
+        system = self.system_text(goal)
+        # user 文本很短（模式 + 尺寸），按 60 token 上限估算，含消息框架开销
+        text_tokens = estimate_text_tokens(system) + estimate_text_tokens(note) + 60
+        text_tokens += sum(estimate_image_tokens(size, self.model, "low") for size in extra_images)
+        if text_tokens > self.max_tokens:
+            raise ValueError(f"prompt text alone needs ~{text_tokens} tokens > budget {self.max_tokens}")
+
+        plan = None
+        for detail in ("high", "low"):
+            for side in (IMAGE_SIDES if detail == "high" else IMAGE_SIDES[-1:]):
+                img_tokens = estimate_image_tokens(fit_size(*orig_size, side), self.model, detail)
+                if text_tokens + img_tokens <= self.max_tokens:
+                    plan = (side, detail, img_tokens)
+                    break
+            if plan:
+                break
+        if plan is None:
+            raise ValueError(f"prompt needs > {self.max_tokens} tokens even with a low-detail image")
+        side, detail, img_tokens = plan
+        if side != IMAGE_SIDES[0] or detail != "high":
+            print(f"[PROMPT] over budget at full size, image → max_side={side} detail={detail}")
+        res_size = fit_size(*orig_size, side)
+        user_text = f"MODE: {mode.upper()} (orig={tuple(orig_size)}, resized={res_size}). Return JSON only."
+        if note:
+            user_text += f"\n{note}"
+        return {
+            "system": system,
+            "user_text": user_text,
+            "max_side": side,
+            "detail": detail,
+            "res_size": res_size,
+            "est_tokens": text_tokens + img_tokens,
+            "prefix_sha": hashlib.sha1(system.encode("utf-8")).hexdigest()[:10],
+        }
+
+    def report(self, req: Dict[str, Any], mode: str, prompt_tokens: Optional[int], cached_tokens: Optional[int] = None):
+        """每次调用后打印 prompt token，累计到 stats"""
+        self.stats["calls"] += 1
+        self.stats["est_tokens"] += req["est_tokens"]
+        self.stats["prompt_tokens"] += prompt_tokens or 0
+        self.stats["cached_tokens"] += cached_tokens or 0
+        print(f"[PROMPT] mode={mode} prefix={req['prefix_sha']} est={req['est_tokens']} "
+              f"actual={prompt_tokens} cached={cached_tokens} budget={self.max_tokens}")
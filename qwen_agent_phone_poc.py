@@ -4,11 +4,22 @@ from dotenv import load_dotenv
 import requests
 from appium.options.android.uiautomator2.base import UiAutomator2Options
 from appium import webdriver
+from selenium.webdriver.remote.remote_connection import RemoteConnection
 
 from PIL import Image
 
 from dashscope import MultiModalConversation
 
+from app_index import try_direct_launch
+from screen_search import appium_scroll_find
+from template_match import known_target_bbox
+from goal_budget import GoalBudget, BudgetExceeded, run_with_timeout
+from trace_archive import TraceArchive
+from device_state import get_appium_state, png_size
+from gesture_macro import run_macro
+from prompt_compiler import PromptCompiler, estimate_image_tokens
+import frame_diff
+
 # ---------- 环境 ----------
 load_dotenv()
 ADB = os.getenv("ADB_HOST_PORT")
@@ -19,6 +30,10 @@ QWEN_URL = os.getenv("QWEN_URL")
 
 AGENT_GOAL = os.getenv("AGENT_GOAL", "Open the Settings app.")
 MAX_STEPS = int(os.getenv("MAX_STEPS", "10"))
+# 每个 Appium HTTP 命令的超时（秒）；设备卡住时命令抛异常，而不是把主循环挂住
+APPIUM_CMD_TIMEOUT = float(os.getenv("APPIUM_CMD_TIMEOUT", "20"))
+# 会话开了 unicodeKeyboard，当前输入法是 Appium 的，ADBKeyBoard 广播没人接；中文走剪贴板粘贴
+TEXT_METHOD = "clipboard"
 
 ADB_DIR = os.getenv("ADB_DIR")
 if os.path.isdir(ADB_DIR) and ADB_DIR not in os.environ.get("PATH", ""):
@@ -58,6 +73,8 @@ def build_driver(adb_host_port):
         "skipServerInstallation": True
     }
     options = UiAutomator2Options().load_capabilities(caps)
+    # 连接池在建 driver 时按这个值创建，之后所有命令都受它限制
+    RemoteConnection.set_timeout(APPIUM_CMD_TIMEOUT)
     return webdriver.Remote(APPIUM, options=options)
 
 
@@ -94,8 +111,8 @@ def _encode_image_for_api(png_bytes: bytes, max_side=1280, target_kb=1500) -> di
 
 
 def screen_size(driver):
-    s = driver.get_window_size()
-    return s["width"], s["height"]
+    # 设备状态缓存：尺寸取自最近一次截图的 PNG 头，没有截图时才远程探测
+    return get_appium_state(driver, ADB).size
 
 
 def clamp_bbox(b, W, H):
@@ -113,15 +130,26 @@ def center_of(b):  # bbox中心
     return int(x + w / 2), int(y + h / 2)
 
 
+def to_device_bbox(b, W, H, res_size=None):
+    # 模型坐标在它看到的缩放图里（user_text 的 resized=...），按比例还原成设备像素再裁剪；
+    # res_size 为空表示 bbox 已经是设备像素（模板匹配 / 控件树）
+    rw, rh = res_size or (W, H)
+    sx, sy = W / float(rw), H / float(rh)
+    x, y, w, h = b
+    return clamp_bbox([x * sx, y * sy, w * sx, h * sy], W, H)
+
+
 # ---------- 与 VLM 通信 ----------
 SYS_PROMPT = """You are a mobile UI agent. You see Android screenshots and a natural-language goal.
 You must reason step-by-step internally and output ONLY a STRICT JSON action with this schema:
 
 {
-  "action": "tap|long_tap|swipe|back|home|type|done|fail",
+  "action": "tap|long_tap|swipe|back|home|type|find|macro|done|fail",
   "bbox": [x,y,w,h],           // required for tap/long_tap/type; omit for others
-  "text": "string",            // required for type
-  "swipe": "up|down|left|right", // required for swipe
+  "steps": [{"op":"tap","bbox":[x,y,w,h]}, {"op":"text","text":"..."}, {"op":"keyevent","keycode":66}],
+                               // required for macro: ≤20 ops of tap|long_tap|text|keyevent|swipe|wait
+  "text": "string",            // required for type; for find: the visible label to look for
+  "swipe": "up|down|left|right", // required for swipe; scroll direction for find
   "reason": "short why this action helps"
 }
 
@@ -129,6 +157,8 @@ Rules:
 - Always output valid JSON and nothing else.
 - Prefer tapping clearly labeled buttons/icons that progress toward the goal.
 - If a search field is visible and relevant, choose type with bbox and give the query text.
+- For a short fixed sequence on the current screen (tap field, type, ENTER), output one {"action":"macro","steps":[...]}.
+- If the target item is in a long scrollable list but not visible yet, output {"action":"find","text":"<label>","swipe":"up"}; it scrolls until the label appears and taps it.
 - If the current screen already satisfies the goal, output {"action":"done", ...}.
 - If you are certain the goal cannot be achieved from here, output {"action":"fail", ...}.
 """
@@ -142,6 +172,14 @@ VERIFY_PROMPT = """You are a verifier. Given the same goal and a new screenshot,
 Only JSON. Be concise and robust to language differences in UI.
 """
 
+# think / verify 共用一个稳定前缀（见 prompt_compiler.py），按 PROMPT_TOKEN_BUDGET 控制截图大小
+PROMPTS = PromptCompiler(SYS_PROMPT, VERIFY_PROMPT, "qwen-vl-plus")
+
+# 设置 TRACE_ARCHIVE_DIR 后，每次模型调用的截图 / prompt / 原始回复由后台线程归档（见 trace_archive.py）
+TRACE_ARCHIVE_DIR = os.getenv("TRACE_ARCHIVE_DIR")
+_trace_run = None  # 当前运行的 TraceRun
+_trace_step = 0  # 当前步号，归档记录用
+
 
 def _png_to_jpeg_dataurl(png_bytes, max_side=1024, quality=85) -> str:
     """压缩 PNG → JPEG 并返回 data URL 字符串"""
@@ -202,25 +240,56 @@ def _extract_text(resp_dict: dict) -> str:
     raise RuntimeError(f"Unexpected response shape: keys={list(resp_dict.keys())}, resp={resp_dict}")
 
 
-def call_qwen(prompt_text: str, img_png: bytes) -> str:
-    data_url = _png_to_jpeg_dataurl(img_png)
-
-    # SDK 使用 messages（OpenAI 风格），兼容多模态
-    messages = [{
-        "role": "user",
-        "content": [
-            {"text": prompt_text},
-            {"image": data_url}
-        ]
-    }]
+def call_qwen(goal: str, img_png: bytes, budget: GoalBudget = None, stage: str = "think", diff: dict = None,
+              req: dict = None) -> str:
+    """diff: frame_diff.diff_frames 的结果；kind=crop 时只发缩略图 + 变化区域裁剪。
+    req: 调用方已编译好的整帧 prompt（无 diff 时复用，不再编译一次）"""
+    mode = "verify" if stage == "verify" else "act"
+    if diff and diff["kind"] == "crop":
+        req = PROMPTS.compile(goal, mode, frame_diff.crop_size(diff), note=frame_diff.crop_note(diff),
+                              extra_images=[frame_diff.thumb_size(diff)])
+        images = frame_diff.crop_images(diff, req["max_side"])
+    elif diff:
+        # 差分时已经解码过整帧，直接复用
+        req = PROMPTS.compile(goal, mode, diff["size"])
+        images = [frame_diff.full_image(diff, req["max_side"])]
+    else:
+        orig_size = png_size(img_png) or Image.open(io.BytesIO(img_png)).size
+        req = req or PROMPTS.compile(goal, mode, orig_size)
+        data_url = _png_to_jpeg_dataurl(img_png, max_side=req["max_side"])
+        images = [{"data_url": data_url, "bytes": len(data_url.split(",", 1)[1]) * 3 // 4, "size": req["res_size"]}]
+    if len(images) == 1:
+        frame_diff.STATS.observe_full(images[0]["bytes"], images[0]["size"])
+
+    # SDK 使用 messages（OpenAI 风格），兼容多模态；system 段对同一目标逐字节不变，便于命中缓存
+    messages = [
+        {"role": "system", "content": [{"text": req["system"]}]},
+        {"role": "user", "content": [{"text": req["user_text"]}] + [{"image": im["data_url"]} for im in images]}
+    ]
 
     # 模型务必用多模态：qwen-vl-plus 或 qwen2-vl-72b-instruct
-    rsp = MultiModalConversation.call(
+    kwargs = dict(
         model="qwen-vl-plus",
         messages=messages,
         api_key=QWEN_API_KEY,
         result_format="json"  # 返回 JSON 字符串
     )
+    if budget:
+        # SDK 调用本身没有可靠的超时，放到守护线程里按自适应超时等待
+        budget.check(stage)
+        t0 = time.monotonic()
+        try:
+            rsp = run_with_timeout(MultiModalConversation.call, budget.timeout_for(stage), **kwargs)
+        finally:
+            budget.observe(stage, time.monotonic() - t0)
+    else:
+        t0 = time.monotonic()
+        rsp = MultiModalConversation.call(**kwargs)
+    if diff:
+        sent_tokens = (frame_diff.image_tokens(images, kwargs["model"]) if diff["kind"] == "crop"
+                       else estimate_image_tokens(images[0]["size"], kwargs["model"]))
+        frame_diff.STATS.record(diff, kwargs["model"], sum(im["bytes"] for im in images), sent_tokens,
+                                time.monotonic() - t0)
 
     # 统一转为 dict 再解析，避免属性/下标差异导致的 KeyError
     try:
@@ -233,53 +302,83 @@ def call_qwen(prompt_text: str, img_png: bytes) -> str:
         raise RuntimeError(
             f"DashScope SDK error: {resp.get('code')} <{resp.get('status_code')}> {resp.get('message')} {resp.get('request_id')}")
 
+    usage = resp.get("usage") or {}
+    PROMPTS.report(req, mode, usage.get("input_tokens"),
+                   (usage.get("prompt_tokens_details") or {}).get("cached_tokens"))
+    if budget:
+        budget.record_usage(kwargs["model"], usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+
     text = _extract_text(resp)
+    if _trace_run:
+        _trace_run.log(_trace_step, stage, frame=img_png, prompt=req["system"], response=text, model=kwargs["model"],
+                       payload=diff["kind"] if diff else "full")
     return text.strip().strip("```").replace("```json","").strip()
 
 
-def think_action(goal: str, screenshot: bytes) -> Dict[str, Any]:
-    prompt = f"{SYS_PROMPT}\n\nGoal: {goal}\nReturn JSON only."
-    out = call_qwen(prompt, screenshot)
+def think_action(goal: str, screenshot: bytes, budget: GoalBudget = None, req: dict = None) -> Dict[str, Any]:
+    out = call_qwen(goal, screenshot, budget, "think", req=req)
     return json.loads(out)
 
 
-def verify_progress(goal: str, screenshot: bytes) -> Dict[str, Any]:
-    prompt = f"{VERIFY_PROMPT}\n\nGoal: {goal}\nJSON only."
-    out = call_qwen(prompt, screenshot)
+def verify_progress(goal: str, screenshot: bytes, budget: GoalBudget = None, pre_frame: bytes = None) -> Dict[str, Any]:
+    """给了动作前的截图时先做差分：没变化直接返回 skipped，变化小只发裁剪"""
+    diff = None
+    if pre_frame is not None:
+        diff = frame_diff.diff_frames(pre_frame, screenshot, PROMPTS.model)
+        print(f"[DIFF] {diff['kind']} changed={diff['changed_frac']} regions={len(diff['regions'])} ({diff['diff_ms']}ms)")
+        if diff["kind"] == "skip":
+            frame_diff.STATS.record(diff, PROMPTS.model)
+            return {"progress": 0, "done": False, "skipped": True, "hint": "screen did not change after the last action"}
+    out = call_qwen(goal, screenshot, budget, "verify", diff)
     return json.loads(out)
 
 
 # ---------- 执行动作 ----------
-def act(driver, action: Dict[str, Any]):
+def _resolve_px(step: Dict[str, Any], W: int, H: int, res_size=None) -> Dict[str, Any]:
+    """宏步骤坐标（缩放图像素）→ 设备像素"""
+    if "bbox" in step:
+        return {"tap_px": center_of(to_device_bbox(step["bbox"], W, H, res_size))}
+    if "tap_point" in step:
+        rw, rh = res_size or (W, H)
+        x, y = step["tap_point"]
+        x, y = int(float(x) * W / rw), int(float(y) * H / rh)
+        return {"tap_px": (max(0, min(x, W - 1)), max(0, min(y, H - 1)))}
+    return {}
+
+
+def act(driver, action: Dict[str, Any], res_size=None, timeout: float = None):
+    """
+    res_size: 模型看到的缩放图尺寸，动作坐标从这个空间映射回设备像素；None 表示已是设备像素。
+    timeout: 本步 act 阶段的超时；adb 宏和滚动查找按它限制时长，单个 Appium 命令受 APPIUM_CMD_TIMEOUT 限制
+    """
     W, H = screen_size(driver)
     a = action.get("action")
-    if a in ("tap", "long_tap", "type"):
-        bbox = clamp_bbox(action.get("bbox", [0, 0, 10, 10]), W, H)
+    if a == "type" and action.get("text", "").strip():
+        # 点击聚焦 + 等待 + 输入合成一个宏，一次 adb shell 完成；文本正确转义，中文走剪贴板
+        run_macro(ADB, [{"op": "tap", "bbox": action.get("bbox", [0, 0, 10, 10])},
+                        {"op": "wait", "wait_ms": 300},
+                        {"op": "text", "text": action["text"].strip()}],
+                  lambda step: _resolve_px(step, W, H, res_size), (W, H), timeout=timeout or 30,
+                  text_method=TEXT_METHOD)
+    elif a in ("tap", "long_tap", "type"):
+        bbox = to_device_bbox(action.get("bbox", [0, 0, 10, 10]), W, H, res_size)
         x, y = center_of(bbox)
         duration = 600 if a == "long_tap" else 80
         driver.execute_script("mobile: clickGesture", {"x": x, "y": y, "duration": duration})
-        if a == "type":
-            text = action.get("text", "").strip()
-            if text:
-                # 轻等待聚焦输入框
-                time.sleep(0.3)
-                # 用 adb 直接输入更稳：避免键盘布局问题
-                run(["adb", "-s", os.getenv("ADB_HOST_PORT"), "shell", "input", "text", text.replace(" ", "%s")])
+    elif a == "macro":
+        run_macro(ADB, action.get("steps", []), lambda step: _resolve_px(step, W, H, res_size), (W, H), timeout=timeout or 30,
+                  text_method=TEXT_METHOD)
     elif a == "swipe":
-        dir = action.get("swipe", "down")
-        sx = int(W * 0.5);
-        ex = sx
-        sy = int(H * 0.75);
-        ey = int(H * 0.25)
-        if dir == "up":
-            sx, sy, ex, ey = int(W * 0.5), int(H * 0.7), int(W * 0.5), int(H * 0.3)
-        elif dir == "down":
-            sx, sy, ex, ey = int(W * 0.5), int(H * 0.3), int(W * 0.5), int(H * 0.7)
-        elif dir == "left":
-            sx, sy, ex, ey = int(W * 0.7), int(H * 0.5), int(W * 0.3), int(H * 0.5)
-        elif dir == "right":
-            sx, sy, ex, ey = int(W * 0.3), int(H * 0.5), int(W * 0.7), int(H * 0.5)
+        sx, sy, ex, ey = get_appium_state(driver, ADB).swipe_points(action.get("swipe", "down"))
         driver.swipe(sx, sy, ex, ey, 300)
+    elif a == "find" and not action.get("text", "").strip():
+        print("[WARN] find without text, skipped:", action)
+    elif a == "find":
+        bbox = appium_scroll_find(driver, action.get("text", ""), action.get("swipe", "up"), size=(W, H),
+                                  timeout=timeout)
+        if bbox and action.get("tap", True):
+            x, y = center_of(bbox)
+            driver.execute_script("mobile: clickGesture", {"x": x, "y": y, "duration": 80})
     elif a == "back":
         driver.back()
     elif a == "home":
@@ -289,69 +388,134 @@ def act(driver, action: Dict[str, Any]):
     else:
         # 未知动作：忽略
         pass
+    get_appium_state(driver, ADB).invalidate_foreground()
     time.sleep(0.6)  # 动作后等待界面稳定
 
 
 # ---------- 主循环 ----------
 def main():
+    global _trace_run, _trace_step
     if not ADB: raise RuntimeError("请在 .env 设置 ADB_HOST_PORT")
     print("[AGENT] goal:", AGENT_GOAL)
     print("[SETUP] connect ADB:", ADB)
     adb_connect(ADB)
     driver = build_driver(ADB)
+    # 截止时间 / token / 费用预算，每个阶段开始前检查，超限带部分结果退出
+    budget = GoalBudget(AGENT_GOAL)
+    state = get_appium_state(driver, ADB)
+    status, reason, step, progress = "max_steps", "", 0, 0
+    archive = TraceArchive(TRACE_ARCHIVE_DIR) if TRACE_ARCHIVE_DIR else None
+    if archive:
+        _trace_run = archive.start_run(AGENT_GOAL, device=ADB)
 
     try:
-        # 起步回到桌面，避免卡在奇怪界面
-        driver.press_keycode(3);
-        time.sleep(1.2)
-
-        progress = 0
+        # “打开 X” 类目标直接通过 activity intent 启动，省掉 HOME→上滑→找图标
+        launched = try_direct_launch(ADB, AGENT_GOAL)
+        if launched == "done":
+            print("[DONE] direct launch")
+            status, reason = "done", "direct launch"
+            return
+
+        if not launched:
+            # 起步回到桌面，避免卡在奇怪界面；近似命中已启动应用时留在应用里让模型确认
+            driver.press_keycode(3);
+            time.sleep(1.2)
+
+        last_template = None
         for step in range(1, MAX_STEPS + 1):
             print(f"\n[STEP {step}] observe")
-            img = screenshot_png(driver)
+            _trace_step = step
+            with budget.stage("observe"):
+                img = screenshot_png(driver)
+            orig_size = state.observe_frame(img)  # 读 PNG 头判断是否旋转，不做远程调用
 
             print("[STEP] think")
             try:
-                action = think_action(AGENT_GOAL, img)
+                # 已知目标（模板库里有）先本地匹配，命中就省掉一次模型调用
+                hit = known_target_bbox(AGENT_GOAL, img)
+                if hit and hit["name"] != last_template:
+                    action = {"action": "tap", "bbox": hit["bbox"], "reason": f"template match: {hit['name']}"}
+                    last_template = hit["name"]
+                    res_size = None  # 模板框已经是设备像素
+                else:
+                    # act prompt 只编译一次：发图用它，res_size 是模型坐标所在的缩放图尺寸
+                    req = PROMPTS.compile(AGENT_GOAL, "act", orig_size)
+                    res_size = req["res_size"]
+                    action = think_action(AGENT_GOAL, img, budget, req)
+                    last_template = None
+            except BudgetExceeded:
+                raise
             except Exception as e:
                 print("[ERROR] think failed:", e)
                 # 简单自愈：尝试下滑刷新
-                driver.swipe(300, 500, 300, 1200, 300)
+                driver.swipe(*state.swipe_points("down"), 300)
                 continue
 
             print("[ACTION]", action)
 
             if action.get("action") == "done":
                 print("[DONE] model认为已达成");
+                status = "done"
                 break
             if action.get("action") == "fail":
                 print("[FAIL] model认为无法达成");
+                status, reason = "fail", action.get("reason", "")
                 break
 
             print("[STEP] act")
-            try:
-                act(driver, action)
-            except Exception as e:
-                print("[ERROR] act failed:", e)
-                # 退一步：按返回
-                driver.back();
-                time.sleep(0.6)
+            with budget.stage("act") as timeout:
+                try:
+                    # 在主线程里执行：超时的动作不会在后台继续点屏幕
+                    act(driver, action, res_size, timeout)
+                except Exception as e:
+                    print("[ERROR] act failed:", e)
+                    # 退一步：按返回
+                    driver.back();
+                    time.sleep(0.6)
+            if _trace_run:
+                _trace_run.log(step, "act", action=action)
 
             print("[STEP] verify")
-            img2 = screenshot_png(driver)
+            with budget.stage("observe"):
+                img2 = screenshot_png(driver)
+            state.observe_frame(img2)
             try:
-                v = verify_progress(AGENT_GOAL, img2)
+                v = verify_progress(AGENT_GOAL, img2, budget, pre_frame=img)
                 print("[VERIFY]", v)
+                if v.get("skipped"):
+                    # 屏幕没变，没有调用模型；归档里照样留一条 verify 记录
+                    if _trace_run:
+                        _trace_run.log(step, "verify", frame=img2, payload="skip", skipped=True, hint=v.get("hint"))
+                    continue
                 progress = max(progress, int(v.get("progress", 0)))
                 if v.get("done") is True or progress >= 95:
                     print("[DONE] verify达成");
+                    status = "done"
                     break
+            except BudgetExceeded:
+                raise
             except Exception as e:
                 print("[WARN] verify failed:", e)
 
         print(f"\n[RESULT] progress≈{progress}%")
 
+    except BudgetExceeded as e:
+        print("[ABORT] budget exceeded:", e)
+        status, reason = "aborted", str(e)
+    except TimeoutError as e:
+        print("[ABORT] model call timed out:", e)
+        status, reason = "aborted", str(e)
+    except Exception as e:
+        print("[ERROR] run failed:", e)
+        status, reason = "error", f"{type(e).__name__}: {e}"
+
     finally:
+        summary = budget.finish(status, reason, steps=step, progress=progress,
+                                verify_payload=frame_diff.STATS.summary())
+        if _trace_run:
+            _trace_run.close(**summary)
+            archive.flush()
+            print("[TRACE] run:", _trace_run.run_id)
         try:
             driver.quit()
         except:
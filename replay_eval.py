@@ -0,0 +1,276 @@
+"""
+离线回放评估：在录制的屏幕数据集上对比不同模型 / prompt 变体。
+
+数据集是一个目录:
+  <dataset>/samples.jsonl   每行一个样本
+  <dataset>/frames/*.png    原始截图（设备分辨率）
+
+样本字段:
+  {"id": "3f9c0a1b7e42", "frame": "frames/3f9c0a1b7e42.png", "goal": "Open Settings app",
+   "action": {...被接受的动作，坐标为模型所见的缩放图空间...},
+   "device_size": [W, H], "res_size": [w, h],
+   "target_bbox": [x, y, w, h]}   # 可选，设备像素；缺省时由 action 推导
+
+用法:
+  python replay_eval.py data/settings_ds \
+      --variant openai:gpt-4o-mini:system_prompt.txt \
+      --variant qwen:qwen-vl-plus:system_prompt.txt \
+      --concurrency 4 --min-accuracy 0.8
+"""
+import os, json, time, uuid, argparse, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional
+
+from model_io import load_prompt, png_to_jpeg_dataurl_and_sizes, map_action_coords_to_device, force_parse_json
+from pricing import estimate_cost
+from prompt_compiler import PromptCompiler
+from device_state import fit_size
+
+TAP_ACTIONS = ("tap", "long_tap")
+VERIFY_PROMPT = load_prompt("verify_prompt.txt")
+
+
+# ---------- 数据集 ----------
+def append_sample(dataset_dir: str, frame_png: bytes, goal: str, action: dict, device_size, res_size,
+                  target_bbox: Optional[list] = None) -> str:
+    """追加一条录制样本，返回样本 id"""
+    frames_dir = os.path.join(dataset_dir, "frames")
+    os.makedirs(frames_dir, exist_ok=True)
+    index_path = os.path.join(dataset_dir, "samples.jsonl")
+    # 随机 id：并发录制或删过样本后按行数编号会撞名覆盖已有截图
+    sample_id = uuid.uuid4().hex[:12]
+    frame_rel = f"frames/{sample_id}.png"
+    with open(os.path.join(dataset_dir, frame_rel), "wb") as f:
+        f.write(frame_png)
+    sample = {"id": sample_id, "frame": frame_rel, "goal": goal, "action": action,
+              "device_size": list(device_size), "res_size": list(res_size)}
+    if target_bbox:
+        sample["target_bbox"] = list(target_bbox)
+    with open(index_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+    return sample_id
+
+
+def load_dataset(dataset_dir: str) -> List[Dict[str, Any]]:
+    samples = []
+    with open(os.path.join(dataset_dir, "samples.jsonl"), "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            s = json.loads(line)
+            s["frame_path"] = os.path.join(dataset_dir, s["frame"])
+            samples.append(s)
+    return samples
+
+
+def target_bbox_of(sample: dict) -> Optional[list]:
+    """样本的目标框（设备像素 [x,y,w,h]）；只给了点的动作没有可用目标框"""
+    if sample.get("target_bbox"):
+        return sample["target_bbox"]
+    accepted = sample["action"]
+    if accepted.get("action") not in TAP_ACTIONS:
+        return None
+    res_size = sample.get("res_size") or fit_size(*sample["device_size"], 1024)
+    mapped = map_action_coords_to_device(accepted, sample["device_size"], res_size)
+    return mapped.get("bbox_px")
+
+
+# ---------- 变体 / Provider ----------
+def parse_variant(spec: str) -> dict:
+    """provider:model[:prompt_file]，prompt 缺省为 system_prompt.txt"""
+    parts = spec.split(":", 2)
+    if len(parts) < 2 or parts[0] not in ("openai", "qwen"):
+        raise ValueError(f"bad variant spec: {spec!r} (want provider:model[:prompt])")
+    prompt_file = parts[2] if len(parts) == 3 else "system_prompt.txt"
+    if os.path.isfile(prompt_file):
+        with open(prompt_file, "r", encoding="utf-8") as f:
+            prompt = f.read().strip()
+    else:
+        prompt = load_prompt(prompt_file)
+    name = f"{parts[0]}:{parts[1]}:{os.path.basename(prompt_file)}"
+    # 与线上一致：同样经过 PromptCompiler 组装前缀和控制 token 预算
+    return {"name": name, "provider": parts[0], "model": parts[1], "prompt": prompt,
+            "compiler": PromptCompiler(prompt, VERIFY_PROMPT, parts[1])}
+
+
+_openai_client = None
+_openai_lock = threading.Lock()
+
+
+def _get_openai_client():
+    global _openai_client
+    with _openai_lock:
+        if _openai_client is None:
+            from openai import OpenAI
+            _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return _openai_client
+
+
+def _call_openai_variant(variant: dict, req: dict, data_url: str):
+    resp = _get_openai_client().chat.completions.create(
+        model=variant["model"],
+        temperature=0,
+        messages=[
+            {"role": "system", "content": req["system"]},
+            {"role": "user", "content": [
+                {"type": "text", "text": req["user_text"]},
+                {"type": "image_url", "image_url": {"url": data_url, "detail": req["detail"]}}
+            ]}
+        ]
+    )
+    usage = resp.usage
+    return resp.choices[0].message.content, usage.prompt_tokens, usage.completion_tokens
+
+
+def _call_qwen_variant(variant: dict, req: dict, data_url: str):
+    from dashscope import MultiModalConversation
+    rsp = MultiModalConversation.call(
+        model=variant["model"],
+        messages=[
+            {"role": "system", "content": [{"text": req["system"]}]},
+            {"role": "user", "content": [{"text": req["user_text"]}, {"image": data_url}]}
+        ],
+        api_key=os.getenv("QWEN_API_KEY"),
+        result_format="json"
+    )
+    resp = json.loads(rsp.to_json())
+    if resp.get("status_code") and resp["status_code"] != 200:
+        raise RuntimeError(f"DashScope SDK error: {resp.get('code')} {resp.get('message')}")
+    content = resp["output"]["choices"][0]["message"]["content"]
+    if isinstance(content, list):
+        content = "\n".join(seg["text"] for seg in content if isinstance(seg, dict) and "text" in seg)
+    usage = resp.get("usage") or {}
+    return content, int(usage.get("input_tokens", 0)), int(usage.get("output_tokens", 0))
+
+
+PROVIDERS = {"openai": _call_openai_variant, "qwen": _call_qwen_variant}
+
+
+# ---------- 评分 ----------
+def _inside(pt, bbox) -> bool:
+    x, y, w, h = bbox
+    return x <= pt[0] <= x + w and y <= pt[1] <= y + h
+
+
+def run_one(variant: dict, sample: dict) -> dict:
+    """对单个样本回放单个变体，返回打分记录"""
+    with open(sample["frame_path"], "rb") as f:
+        png = f.read()
+    req = variant["compiler"].compile(sample["goal"], "act", tuple(sample["device_size"]))
+    data_url, orig_size, res_size = png_to_jpeg_dataurl_and_sizes(png, max_side=req["max_side"])
+    expected = sample["action"].get("action")
+    target = target_bbox_of(sample) if expected in TAP_ACTIONS else None
+    # 出错的样本计为不一致 / 未命中，避免错误率高的变体“看起来”准确
+    rec = {"variant": variant["name"], "id": sample["id"], "error": None, "agree": False}
+    if target:
+        rec["tap_hit"] = False
+    t0 = time.perf_counter()
+    try:
+        text, tok_in, tok_out = PROVIDERS[variant["provider"]](variant, req, data_url)
+        pred = force_parse_json(text)
+    except Exception as e:
+        rec.update(latency=time.perf_counter() - t0, error=str(e)[:200], tokens_in=0, tokens_out=0)
+        return rec
+    rec.update(latency=time.perf_counter() - t0, tokens_in=tok_in, tokens_out=tok_out,
+               cost=estimate_cost(variant["model"], tok_in, tok_out), pred=pred)
+
+    rec["agree"] = pred.get("action") == expected
+    if target:
+        mapped = map_action_coords_to_device(pred, orig_size, res_size)
+        rec["tap_hit"] = "tap_px" in mapped and _inside(mapped["tap_px"], target)
+    return rec
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    v = sorted(values)
+    k = min(len(v) - 1, max(0, int(round(q / 100.0 * (len(v) - 1)))))
+    return v[k]
+
+
+def summarize(records: List[dict]) -> dict:
+    n = len(records)
+    ok = [r for r in records if not r["error"]]
+    taps = [r for r in records if "tap_hit" in r]
+    lat = [r["latency"] for r in ok]
+    return {
+        "samples": n,
+        "errors": n - len(ok),
+        "agreement": sum(r["agree"] for r in records) / n if n else 0.0,
+        "tap_samples": len(taps),
+        "tap_accuracy": sum(r["tap_hit"] for r in taps) / len(taps) if taps else None,
+        "latency_p50": _percentile(lat, 50),
+        "latency_p95": _percentile(lat, 95),
+        "tokens_in": sum(r["tokens_in"] for r in records),
+        "tokens_out": sum(r["tokens_out"] for r in records),
+        "cost_usd": sum(r.get("cost", 0.0) for r in ok),
+    }
+
+
+def evaluate(samples: List[dict], variants: List[dict], concurrency: int = 4) -> Dict[str, dict]:
+    """所有 (变体, 样本) 组合共享一个有界线程池并行回放"""
+    per_variant = {v["name"]: [] for v in variants}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(run_one, v, s) for v in variants for s in samples]
+        for fut in as_completed(futures):
+            rec = fut.result()
+            per_variant[rec["variant"]].append(rec)
+    return {name: {"summary": summarize(recs), "records": sorted(recs, key=lambda r: r["id"])}
+            for name, recs in per_variant.items()}
+
+
+def pick_best(results: Dict[str, dict], min_accuracy: float) -> Optional[str]:
+    """动作一致率和点击命中率（有点击样本时）都达到门槛的变体中选 p50 延迟最低者；
+    延迟相同再比一致率、成本"""
+    eligible = []
+    for name, r in results.items():
+        s = r["summary"]
+        acc = s["agreement"]
+        if s["tap_accuracy"] is not None:
+            acc = min(acc, s["tap_accuracy"])
+        if acc >= min_accuracy:
+            eligible.append((s["latency_p50"], -s["agreement"], s["cost_usd"], name))
+    return min(eligible)[-1] if eligible else None
+
+
+def print_report(results: Dict[str, dict], best: Optional[str]):
+    print(f"{'variant':<48} {'n':>4} {'err':>4} {'agree':>6} {'tap':>6} "
+          f"{'p50(s)':>7} {'p95(s)':>7} {'tok_in':>8} {'tok_out':>8} {'cost$':>8}")
+    for name, r in results.items():
+        s = r["summary"]
+        tap = f"{s['tap_accuracy']:.2f}" if s["tap_accuracy"] is not None else "-"
+        print(f"{name:<48} {s['samples']:>4} {s['errors']:>4} {s['agreement']:>6.2f} {tap:>6} "
+              f"{s['latency_p50']:>7.2f} {s['latency_p95']:>7.2f} {s['tokens_in']:>8} "
+              f"{s['tokens_out']:>8} {s['cost_usd']:>8.4f}")
+    print("[BEST]", best or "no variant meets the accuracy bar")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay a recorded screen dataset against model/prompt variants")
+    ap.add_argument("dataset")
+    ap.add_argument("--variant", action="append", required=True,
+                    help="provider:model[:prompt_file], e.g. openai:gpt-4o-mini:system_prompt.txt")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--min-accuracy", type=float, default=0.8)
+    ap.add_argument("--limit", type=int, default=0, help="only replay the first N samples")
+    ap.add_argument("--out", help="write the full JSON report here")
+    args = ap.parse_args()
+
+    samples = load_dataset(args.dataset)
+    if args.limit:
+        samples = samples[:args.limit]
+    variants = [parse_variant(v) for v in args.variant]
+    print(f"[EVAL] {len(samples)} samples x {len(variants)} variants, concurrency={args.concurrency}")
+
+    results = evaluate(samples, variants, args.concurrency)
+    best = pick_best(results, args.min_accuracy)
+    print_report(results, best)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"best": best, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
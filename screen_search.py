@@ -0,0 +1,175 @@
+"""
+滚动查找：在长列表（设置页、应用抽屉）里按文字找元素，不需要每次滑动都调用模型。
+
+每滑动一次就 dump 一次 UI 层级，检查目标文字（text / content-desc）是否出现；
+层级不再变化说明已经到列表底部，停止。找到后返回设备像素 bbox [x,y,w,h]。
+
+模型用一个高层动作调用:
+  {"action": "find", "text": "WLAN", "swipe": "up"}
+"""
+import re, time, hashlib, subprocess
+import xml.etree.ElementTree as ET
+from typing import Callable, List, Optional, Dict, Any
+
+from rapidfuzz import fuzz
+
+from device_state import swipe_points
+
+_BOUNDS_RE = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+
+
+# ---------- 层级解析 ----------
+def parse_hierarchy(xml_text: str) -> List[Dict[str, Any]]:
+    """uiautomator / Appium page_source → 节点列表 {text, desc, bounds:[x,y,w,h]}"""
+    root = ET.fromstring(xml_text)
+    nodes = []
+    for el in root.iter():
+        m = _BOUNDS_RE.match(el.attrib.get("bounds", ""))
+        if not m:
+            continue
+        x0, y0, x1, y1 = map(int, m.groups())
+        if x1 <= x0 or y1 <= y0:
+            continue
+        nodes.append({
+            "text": (el.attrib.get("text") or "").strip(),
+            "desc": (el.attrib.get("content-desc") or "").strip(),
+            "bounds": [x0, y0, x1 - x0, y1 - y0],
+        })
+    return nodes
+
+
+def hierarchy_size(nodes: List[Dict[str, Any]]):
+    """根节点（面积最大）的宽高，即屏幕尺寸"""
+    x, y, w, h = max(nodes, key=lambda n: n["bounds"][2] * n["bounds"][3])["bounds"]
+    return x + w, y + h
+
+
+def match_target(nodes: List[Dict[str, Any]], target: str, threshold: int = 85) -> Optional[Dict[str, Any]]:
+    """精确 > 包含 > 模糊；只看有文字的节点。空目标不匹配任何节点"""
+    t = (target or "").strip().lower()
+    if not t:
+        return None
+    best, best_score = None, 0
+    for n in nodes:
+        for label in (n["text"], n["desc"]):
+            if not label:
+                continue
+            lab = label.lower()
+            if lab == t:
+                score = 101
+            elif t in lab:
+                score = 100 - min(10, len(lab) - len(t))  # 越接近目标长度越好
+            else:
+                score = fuzz.ratio(t, lab)
+            if score > best_score:
+                best, best_score = n, score
+    return best if best_score >= threshold else None
+
+
+def _signature(nodes: List[Dict[str, Any]]) -> str:
+    h = hashlib.md5()
+    for n in nodes:
+        h.update(f"{n['text']}|{n['desc']}|{n['bounds']}".encode("utf-8"))
+    return h.hexdigest()
+
+
+# ---------- 滚动查找 ----------
+def scroll_find(dump: Callable[[], str], swipe: Callable[[str], None], target: str,
+                direction: str = "up", max_swipes: int = 15, settle_s: float = 0.4,
+                threshold: int = 85, timeout: float = None) -> Optional[List[int]]:
+    """
+    dump() 返回当前层级 XML（失败返回 None），swipe(direction) 执行一次滑动。
+    返回目标的设备像素 bbox；目标为空、dump 失败、到达列表末尾、超过 max_swipes 或 timeout 秒仍未找到返回 None。
+    """
+    if not (target or "").strip():
+        print("[FIND] empty target, skipped")
+        return None
+    deadline = time.monotonic() + timeout if timeout else None
+    last_sig = None
+    for i in range(max_swipes + 1):
+        if deadline and time.monotonic() >= deadline:
+            print(f"[FIND] timed out after {i} swipe(s), {target!r} not found")
+            return None
+        xml_text = dump()
+        try:
+            nodes = parse_hierarchy(xml_text) if xml_text else None
+        except ET.ParseError as e:
+            print("[FIND] hierarchy parse failed:", e)
+            nodes = None
+        if not nodes:
+            print("[FIND] no usable UI hierarchy, giving up")
+            return None
+        hit = match_target(nodes, target, threshold)
+        if hit:
+            print(f"[FIND] {target!r} found after {i} swipe(s): {hit['bounds']}")
+            return hit["bounds"]
+        sig = _signature(nodes)
+        if sig == last_sig:
+            print(f"[FIND] reached list end after {i} swipe(s), {target!r} not found")
+            return None
+        last_sig = sig
+        if i < max_swipes:
+            swipe(direction)
+            time.sleep(settle_s)
+    print(f"[FIND] gave up after {max_swipes} swipes")
+    return None
+
+
+# ---------- adb 后端 ----------
+def adb_dump_hierarchy(host_port: str, timeout: float = 15) -> Optional[str]:
+    """uiautomator dump；超时或输出里没有完整层级时返回 None"""
+    try:
+        out = subprocess.run(["adb", "-s", host_port, "exec-out", "uiautomator", "dump", "/dev/tty"],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout).stdout
+    except subprocess.TimeoutExpired:
+        print(f"[FIND] uiautomator dump timed out after {timeout:.0f}s")
+        return None
+    text = out.decode("utf-8", errors="replace")
+    end = text.rfind("</hierarchy>")
+    start = text.find("<?xml")
+    if end < 0:
+        print(f"[FIND] uiautomator dump failed: {text[:200]}")
+        return None
+    return text[max(0, start):end + len("</hierarchy>")]
+
+
+def adb_scroll_find(host_port: str, target: str, direction: str = "up", size=None, timeout: float = None,
+                    **kw) -> Optional[List[int]]:
+    """基于 adb 的 scroll_find；size 缺省时从层级根节点推出屏幕尺寸；timeout 限制整个查找的总时长"""
+    dims = dict(zip("WH", size)) if size else {}
+    deadline = time.monotonic() + timeout if timeout else None
+
+    def call_timeout():
+        # 单次 adb 调用不超过 15 秒，也不超过剩余时间
+        return max(0.5, min(15.0, deadline - time.monotonic())) if deadline else 15.0
+
+    def dump():
+        xml_text = adb_dump_hierarchy(host_port, call_timeout())
+        if xml_text and "W" not in dims:
+            try:
+                dims["W"], dims["H"] = hierarchy_size(parse_hierarchy(xml_text))
+            except (ET.ParseError, ValueError):
+                pass  # 解析失败 / 空层级由 scroll_find 处理，不会走到滑动
+        return xml_text
+
+    def swipe(d):
+        x0, y0, x1, y1 = swipe_points(d, dims["W"], dims["H"])
+        subprocess.run(["adb", "-s", host_port, "shell", "input", "swipe",
+                        str(x0), str(y0), str(x1), str(y1), "300"], check=True, timeout=call_timeout())
+
+    return scroll_find(dump, swipe, target, direction, timeout=timeout, **kw)
+
+
+def appium_scroll_find(driver, target: str, direction: str = "up", size=None, timeout: float = None,
+                       **kw) -> Optional[List[int]]:
+    """基于 Appium driver 的 scroll_find（page_source 即 uiautomator 层级）；timeout 限制总时长"""
+    if size is None:
+        s = driver.get_window_size()
+        size = (s["width"], s["height"])
+    W, H = size
+
+    def swipe(d):
+        x0, y0, x1, y1 = swipe_points(d, W, H)
+        driver.swipe(x0, y0, x1, y1, 300)
+
+    return scroll_find(lambda: driver.page_source, swipe, target, direction, timeout=timeout, **kw)
@@ -0,0 +1,242 @@
+"""
+本地图标/模板匹配：已知目标（设置齿轮、常见权限按钮、桌面图标）不必调用视觉模型。
+
+模板库目录（TEMPLATE_DIR，默认 templates/）:
+  index.json   {name: {"file": "name.png", "labels": ["设置", "Settings"], "src_size": [W, H]}}
+  *.png        从已采集截图里裁下来的灰度模板（原始设备分辨率）
+
+匹配在降采样后的灰度帧上做多尺度归一化互相关（NCC），全部用 NumPy 向量化:
+帧的 FFT 每帧只算一次，模板 FFT 按帧尺寸缓存，局部均值/方差用积分图一次求出。
+
+用法:
+  python template_match.py add settings_gear frames/000012.png 96,410,120,120 --labels 设置,Settings
+  python template_match.py add-sample settings_gear data/ds 000012 --labels 设置,Settings
+  python template_match.py match frame.png
+  python template_match.py bench
+"""
+import os, io, sys, json, time, argparse
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+from PIL import Image
+
+TEMPLATE_DIR = os.getenv("TEMPLATE_DIR", "templates")
+WORK_SIDE = int(os.getenv("TEMPLATE_WORK_SIDE", "320"))  # 匹配时帧长边降采样到的像素数
+MIN_CONF = float(os.getenv("TEMPLATE_MIN_CONF", "0.85"))
+SCALES = (0.85, 1.0, 1.15)
+_MIN_TPL_SIDE = 6  # 降采样后小于这个尺寸的模板不可靠，跳过
+
+
+# ---------- 模板库 ----------
+def _to_gray(img: Image.Image) -> np.ndarray:
+    return np.asarray(img.convert("L"), dtype=np.float32)
+
+
+def load_library(template_dir: str = TEMPLATE_DIR) -> Dict[str, Dict[str, Any]]:
+    """读取 index.json 和模板灰度图；目录不存在时返回空库"""
+    index_path = os.path.join(template_dir, "index.json")
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    lib = {}
+    for name, meta in index.items():
+        with Image.open(os.path.join(template_dir, meta["file"])) as img:
+            lib[name] = dict(meta, gray=_to_gray(img))
+    return lib
+
+
+def add_template(name: str, frame_png: bytes, bbox, labels: List[str], template_dir: str = TEMPLATE_DIR):
+    """从一张已采集的截图里按设备像素 bbox [x,y,w,h] 裁出模板并登记"""
+    os.makedirs(template_dir, exist_ok=True)
+    src = Image.open(io.BytesIO(frame_png))
+    x, y, w, h = [int(v) for v in bbox]
+    src.crop((x, y, x + w, y + h)).convert("L").save(os.path.join(template_dir, f"{name}.png"))
+
+    index_path = os.path.join(template_dir, "index.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    index[name] = {"file": f"{name}.png", "labels": list(labels), "src_size": list(src.size)}
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+
+
+# ---------- 匹配 ----------
+class TemplateMatcher:
+    """持有模板库和按帧尺寸缓存的模板 FFT；同一设备上帧尺寸不变，缓存一直命中"""
+
+    def __init__(self, library: Dict[str, Dict[str, Any]], work_side: int = WORK_SIDE, scales=SCALES):
+        self.library = library
+        self.work_side = work_side
+        self.scales = scales
+        self._fft_cache = {}  # (name, scale, frame_shape, device_size) -> (conj FFT, th, tw, tpl_norm)
+
+    def _prepared(self, name: str, scale: float, shape, device_size, f: float):
+        key = (name, scale, shape, device_size)
+        if key not in self._fft_cache:
+            meta = self.library[name]
+            tpl = meta["gray"]
+            # 模板按 采集设备 → 当前设备 → 工作分辨率 缩放
+            k = device_size[0] / float(meta["src_size"][0]) * f * scale
+            th, tw = int(round(tpl.shape[0] * k)), int(round(tpl.shape[1] * k))
+            if th < _MIN_TPL_SIDE or tw < _MIN_TPL_SIDE or th > shape[0] or tw > shape[1]:
+                self._fft_cache[key] = None
+            else:
+                t = np.asarray(Image.fromarray(tpl).resize((tw, th), Image.BILINEAR), dtype=np.float32)
+                t = t - t.mean()
+                norm = float(np.sqrt((t * t).sum()))
+                if norm < 1e-3:  # 纯色模板没有区分度
+                    self._fft_cache[key] = None
+                else:
+                    self._fft_cache[key] = (np.conj(np.fft.rfft2(t, s=shape)), th, tw, norm)
+        return self._fft_cache[key]
+
+    def match(self, frame, names: Optional[List[str]] = None, min_conf: float = MIN_CONF) -> List[Dict[str, Any]]:
+        """
+        frame: PNG bytes 或 PIL Image（设备分辨率）。
+        返回 [{name, confidence, bbox:[x,y,w,h] 设备像素}]，每个模板只保留最佳尺度，按置信度降序。
+        """
+        img = Image.open(io.BytesIO(frame)) if isinstance(frame, (bytes, bytearray)) else frame
+        W, H = img.size
+        f = min(1.0, self.work_side / float(max(W, H)))
+        small = img if f >= 1.0 else img.resize((max(1, int(W * f)), max(1, int(H * f))), Image.BILINEAR)
+        g = _to_gray(small)
+        shape = g.shape
+
+        F = np.fft.rfft2(g)
+        # 积分图：任意窗口的 Σx 与 Σx² 都是 O(1)
+        ii = np.pad(g, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+        ii2 = np.pad(g * g, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+
+        results = []
+        for name in (names if names is not None else self.library):
+            if name not in self.library:
+                continue
+            best = None
+            for scale in self.scales:
+                prep = self._prepared(name, scale, shape, (W, H), f)
+                if prep is None:
+                    continue
+                T, th, tw, tnorm = prep
+                # 循环互相关：只取不越界（无回绕）的有效区域
+                corr = np.fft.irfft2(F * T, s=shape)[:shape[0] - th + 1, :shape[1] - tw + 1]
+                s1 = ii[th:, tw:] - ii[:-th, tw:] - ii[th:, :-tw] + ii[:-th, :-tw]
+                s2 = ii2[th:, tw:] - ii2[:-th, tw:] - ii2[th:, :-tw] + ii2[:-th, :-tw]
+                var = np.maximum(s2 - s1 * s1 / (th * tw), 0.0)
+                denom = np.sqrt(var) * tnorm
+                ncc = np.where(denom > 1e-3 * tnorm, corr / np.maximum(denom, 1e-6), 0.0)
+                idx = int(np.argmax(ncc))
+                yy, xx = divmod(idx, ncc.shape[1])
+                conf = float(ncc[yy, xx])
+                if best is None or conf > best[0]:
+                    best = (conf, xx, yy, tw, th)
+            if best and best[0] >= min_conf:
+                conf, xx, yy, tw, th = best
+                results.append({"name": name, "confidence": round(conf, 4),
+                                "bbox": [int(xx / f), int(yy / f), int(round(tw / f)), int(round(th / f))]})
+        return sorted(results, key=lambda r: -r["confidence"])
+
+    def names_for_goal(self, goal: str) -> List[str]:
+        """目标文字里提到了哪些模板的标签（例如 “Open Settings” → settings_gear）"""
+        g = (goal or "").lower()
+        return [n for n, m in self.library.items() if any(lab.lower() in g for lab in m.get("labels", []))]
+
+
+_default_matcher = None
+
+
+def get_matcher() -> TemplateMatcher:
+    global _default_matcher
+    if _default_matcher is None:
+        _default_matcher = TemplateMatcher(load_library())
+    return _default_matcher
+
+
+def known_target_bbox(goal: str, frame) -> Optional[Dict[str, Any]]:
+    """目标涉及已知模板且在画面里匹配到时返回最佳匹配，否则 None（交给视觉模型）"""
+    matcher = get_matcher()
+    names = matcher.names_for_goal(goal)
+    if not names:
+        return None
+    t0 = time.perf_counter()
+    hits = matcher.match(frame, names)
+    if hits:
+        print(f"[TEMPLATE] {hits[0]['name']} conf={hits[0]['confidence']:.2f} "
+              f"bbox={hits[0]['bbox']} in {(time.perf_counter() - t0) * 1000:.1f}ms")
+        return hits[0]
+    return None
+
+
+# ---------- 基准 ----------
+def benchmark(frame_sizes=((720, 1280), (1080, 1920), (1440, 2560)), template_counts=(1, 5, 10, 20, 40),
+              repeats: int = 5):
+    """合成帧/模板上测匹配耗时（含降采样），打印 帧尺寸 × 模板数 的中位数毫秒"""
+    rng = np.random.default_rng(0)
+    print(f"work_side={WORK_SIDE} scales={SCALES} repeats={repeats}")
+    print(f"{'frame':>10} " + " ".join(f"{f'{n} tpl':>9}" for n in template_counts))
+    for (W, H) in frame_sizes:
+        base = rng.integers(0, 255, size=(H // 16, W // 16), dtype=np.uint8)
+        frame = Image.fromarray(base).resize((W, H), Image.BILINEAR)
+        row = []
+        for n in template_counts:
+            lib = {}
+            for i in range(n):
+                side = int(W * rng.uniform(0.08, 0.18))
+                x, y = int(rng.integers(0, W - side)), int(rng.integers(0, H - side))
+                lib[f"t{i}"] = {"gray": _to_gray(frame.crop((x, y, x + side, y + side))),
+                                "src_size": [W, H], "labels": []}
+            m = TemplateMatcher(lib)
+            m.match(frame, min_conf=2.0)  # 预热：填充模板 FFT 缓存
+            times = []
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                m.match(frame)
+                times.append((time.perf_counter() - t0) * 1000)
+            row.append(sorted(times)[len(times) // 2])
+        print(f"{f'{W}x{H}':>10} " + " ".join(f"{t:>7.1f}ms" for t in row))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Template library and local matcher")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p_add = sub.add_parser("add", help="crop a template from a captured frame")
+    p_add.add_argument("name")
+    p_add.add_argument("frame")
+    p_add.add_argument("bbox", help="x,y,w,h in device pixels")
+    p_add.add_argument("--labels", default="")
+    p_smp = sub.add_parser("add-sample", help="crop the target of a replay dataset sample")
+    p_smp.add_argument("name")
+    p_smp.add_argument("dataset")
+    p_smp.add_argument("sample_id")
+    p_smp.add_argument("--labels", default="")
+    p_match = sub.add_parser("match")
+    p_match.add_argument("frame")
+    sub.add_parser("bench")
+    args = ap.parse_args()
+
+    if args.cmd == "add":
+        with open(args.frame, "rb") as f:
+            add_template(args.name, f.read(), args.bbox.split(","), [s for s in args.labels.split(",") if s])
+    elif args.cmd == "add-sample":
+        from replay_eval import load_dataset, target_bbox_of
+        sample = next(s for s in load_dataset(args.dataset) if s["id"] == args.sample_id)
+        bbox = target_bbox_of(sample)
+        if not bbox:
+            sys.exit(f"sample {args.sample_id} has no target bbox")
+        with open(sample["frame_path"], "rb") as f:
+            add_template(args.name, f.read(), bbox, [s for s in args.labels.split(",") if s])
+    elif args.cmd == "match":
+        with open(args.frame, "rb") as f:
+            t0 = time.perf_counter()
+            hits = get_matcher().match(f.read())
+        print(f"{len(hits)} match(es) in {(time.perf_counter() - t0) * 1000:.1f}ms")
+        for h in hits:
+            print(h)
+    elif args.cmd == "bench":
+        benchmark()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import os, sys
+
+# 模块都在仓库根目录，测试直接按文件名 import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+import pytest
+
+from app_index import search_app, parse_open_goal
+
+INDEX = {"apps": {
+    "com.android.settings": {"activity": "com.android.settings/.Settings", "labels": ["设置", "Settings"]},
+    "com.tencent.mm": {"activity": "com.tencent.mm/.ui.LauncherUI", "labels": ["微信", "WeChat"]},
+    "com.tencent.qqlive": {"activity": None, "labels": ["腾讯视频", "Tencent Video"]},
+}}
+
+
+@pytest.mark.parametrize("query", ["Wi-Fi settings", "Tencent Video", "tencent", "Settings search"])
+def test_search_app_rejects_near_misses(query):
+    assert search_app(INDEX, query) is None
+
+
+@pytest.mark.parametrize("query,pkg", [("settings", "com.android.settings"), ("WeChat", "com.tencent.mm"),
+                                       ("微信", "com.tencent.mm")])
+def test_search_app_exact_label(query, pkg):
+    hit = search_app(INDEX, query)
+    assert hit["package"] == pkg and hit["exact"]
+
+
+def test_search_app_partial_match_is_not_exact():
+    hit = search_app(INDEX, "Setting")
+    assert hit["package"] == "com.android.settings" and not hit["exact"]
+
+
+@pytest.mark.parametrize("goal,name", [("Open the Settings app.", "Settings"), ("打开微信", "微信"),
+                                       ("打开再惠", "再惠"), ("打开设置，再打开 WiFi", None),
+                                       ("Open Settings and enable Wi-Fi", None),
+                                       ("Open Settings to change Wi-Fi", None)])
+def test_parse_open_goal(goal, name):
+    assert parse_open_goal(goal) == name
@@ -0,0 +1,49 @@
+import struct, zlib
+
+from device_state import DeviceState, png_size
+
+
+def _png(w, h):
+    ihdr = struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr
+            + struct.pack(">I", zlib.crc32(b"IHDR" + ihdr)))
+
+
+def _state(probe_info):
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return dict(probe_info)
+
+    return DeviceState("emu", probe, lambda: "com.example"), calls
+
+
+def test_png_size_reads_header_only():
+    assert png_size(_png(1080, 2400)) == (1080, 2400)
+    assert png_size(b"not a png") is None
+
+
+def test_first_frame_sets_size_without_probe():
+    state, calls = _state({"size": (1080, 2274), "orientation": 0, "density": 420})
+    assert state.observe_frame(_png(1080, 2400)) == (1080, 2400)
+    assert state.size == (1080, 2400) and not calls
+
+
+def test_rotation_invalidates_orientation_only():
+    state, calls = _state({"size": (1080, 2400), "orientation": 0, "density": 420})
+    assert (state.orientation, state.density) == (0, 420) and len(calls) == 1
+    state.observe_frame(_png(1080, 2400))
+    assert len(calls) == 1
+
+    state._probe = lambda: {"size": (2400, 1080), "orientation": 1, "density": 420}
+    assert state.observe_frame(_png(2400, 1080)) == (2400, 1080)
+    assert state._density == 420 and state.orientation == 1
+
+
+def test_resolution_change_invalidates_density():
+    state, calls = _state({"size": (1080, 2400), "orientation": 0, "density": 420})
+    state.observe_frame(_png(1080, 2400))
+    assert state.density == 420
+    state.observe_frame(_png(720, 1600))
+    assert state._orientation is None and state._density is None
@@ -0,0 +1,69 @@
+import io
+
+from PIL import Image, ImageDraw
+
+import frame_diff
+from frame_diff import VerifyStats, diff_frames
+
+W, H = 1080, 2400
+
+
+def _png(boxes=(), size=(W, H)):
+    img = Image.new("RGB", size, (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    for box, color in boxes:
+        draw.rectangle(box, fill=color)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+BASE = ((100, 400, 980, 560), (30, 30, 30))
+
+
+def test_identical_frames_skip():
+    plan = diff_frames(_png([BASE]), _png([BASE]))
+    assert plan["kind"] == "skip" and plan["regions"] == [] and plan["changed_frac"] == 0.0
+
+
+def test_status_bar_change_is_ignored():
+    clock = ((900, 10, 1060, 60), (0, 0, 0))
+    assert diff_frames(_png([BASE]), _png([BASE, clock]))["kind"] == "skip"
+
+
+def test_small_change_sends_crop_around_it():
+    toggle = (800, 1200, 960, 1300)
+    plan = diff_frames(_png([BASE]), _png([BASE, (toggle, (0, 120, 255))]))
+    assert plan["kind"] == "crop"
+    x, y, w, h = plan["crop_bbox"]
+    assert x <= toggle[0] and y <= toggle[1] and x + w >= toggle[2] and y + h >= toggle[3]
+    assert plan["changed_frac"] < 0.05
+
+
+def test_large_change_sends_full_frame():
+    page = ((0, 200, W, 2300), (20, 20, 20))
+    assert diff_frames(_png([BASE]), _png([page]))["kind"] == "full"
+
+
+def test_rotation_sends_full_frame():
+    plan = diff_frames(_png([BASE]), _png(size=(H, W)))
+    assert plan["kind"] == "full" and plan["size"] == (H, W)
+
+
+def test_crop_falls_back_to_full_when_it_costs_more_tokens(monkeypatch):
+    # 两个分散在对角的小变化：裁剪框几乎是整屏，缩略图 + 裁剪的切片数不比整帧少
+    monkeypatch.setattr(frame_diff, "FULL_FRAC", 1.0)
+    corners = [((40, 200, 140, 260), (0, 0, 0)), ((940, 2250, 1040, 2330), (0, 0, 0))]
+    pre, post = _png([BASE]), _png([BASE] + corners)
+    assert diff_frames(pre, post)["kind"] == "crop"
+    assert diff_frames(pre, post, "gpt-4o-mini")["kind"] == "full"
+
+
+def test_stats_label_estimates():
+    stats = VerifyStats()
+    stats.observe_full(100_000, (460, 1024))  # 与基线同尺寸的整帧
+    stats.record({"kind": "skip", "size": (W, H)}, "gpt-4o-mini")
+    summary = stats.summary()
+    assert summary["bytes_saved_est"] == 100_000
+    assert summary["tokens_saved_est"] > 0
+    assert summary["kinds"]["skip"]["avg_base_kb_est"] > 0
@@ -0,0 +1,58 @@
+import base64, shlex
+
+import pytest
+
+from gesture_macro import ADBKEYBOARD_IME, MacroError, compile_macro, text_commands
+
+
+def _resolve(step):
+    if "bbox" in step:
+        x, y, w, h = step["bbox"]
+        return {"tap_px": (int(x + w / 2), int(y + h / 2))}
+    return {}
+
+
+def _compile(steps, **kw):
+    return compile_macro(steps, _resolve, (1080, 2400), **kw)
+
+
+@pytest.mark.parametrize("text", ["hello world", "it's \"quoted\"", "a; rm -rf / #", "$(reboot) `id` | x & y",
+                                  "100% off"])
+def test_ascii_text_is_one_shell_word(text):
+    (cmd,) = _compile([{"op": "text", "text": text}])
+    argv = shlex.split(cmd)
+    # 无论文本里有什么 shell 元字符，都只是 input text 的一个参数
+    assert argv[:2] == ["input", "text"] and len(argv) == 3
+    assert argv[2] == text.replace(" ", "%s")
+
+
+def test_multiline_text_presses_enter_between_lines():
+    assert _compile([{"op": "text", "text": "a\nb"}]) == ["input text a", "input keyevent 66", "input text b"]
+
+
+def test_unicode_text_adbkeyboard_checks_ime():
+    check, send = text_commands("北京 weather", method="adbkeyboard")
+    assert ADBKEYBOARD_IME in check and "false" in check
+    b64 = shlex.split(send)[shlex.split(send).index("msg") + 1]
+    assert base64.b64decode(b64).decode("utf-8") == "北京 weather"
+
+
+def test_unicode_text_clipboard_pastes():
+    cmds = _compile([{"op": "text", "text": "你好"}], text_method="clipboard")
+    assert "io.appium.settings.clipboard.set" in cmds[0]
+    assert cmds[1] == "input keyevent 279"
+    assert not any(ADBKEYBOARD_IME in c for c in cmds)
+
+
+def test_macro_compiles_taps_waits_and_keys():
+    cmds = _compile([{"op": "tap", "bbox": [100, 200, 20, 40]}, {"op": "wait", "wait_ms": 250},
+                     {"op": "keyevent", "keycode": "66"}, {"op": "swipe", "swipe": "up"}])
+    assert cmds == ["input tap 110 220", "sleep 0.250", "input keyevent 66", "input swipe 540 1680 540 720 300"]
+
+
+@pytest.mark.parametrize("steps", [[], "tap", [{"op": "rm"}], [{"op": "tap"}], [{"op": "keyevent", "keycode": "3; reboot"}],
+                                   [{"op": "swipe", "swipe": "sideways"}], [{"op": "wait", "wait_ms": 1}] * 21,
+                                   [{"op": "text", "text": ""}]])
+def test_invalid_macros_raise(steps):
+    with pytest.raises(MacroError):
+        _compile(steps)
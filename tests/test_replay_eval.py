@@ -0,0 +1,29 @@
+from replay_eval import append_sample, load_dataset, pick_best
+
+
+def _result(agreement, tap_accuracy, p50, cost=0.01):
+    return {"summary": {"agreement": agreement, "tap_accuracy": tap_accuracy, "latency_p50": p50,
+                        "cost_usd": cost}}
+
+
+def test_pick_best_needs_both_metrics_over_the_bar():
+    results = {"fast-but-wrong-actions": _result(0.5, 1.0, 1.0), "ok": _result(0.9, 0.85, 2.0)}
+    assert pick_best(results, 0.8) == "ok"
+
+
+def test_pick_best_breaks_latency_ties_on_agreement():
+    results = {"a": _result(0.85, 0.9, 1.5, cost=0.001), "b": _result(0.95, 0.9, 1.5, cost=0.01)}
+    assert pick_best(results, 0.8) == "b"
+
+
+def test_pick_best_without_tap_samples_uses_agreement():
+    assert pick_best({"a": _result(0.7, None, 1.0)}, 0.8) is None
+    assert pick_best({"a": _result(0.9, None, 1.0)}, 0.8) == "a"
+
+
+def test_append_sample_ids_are_unique(tmp_path):
+    ids = {append_sample(str(tmp_path), b"png", "Open Settings", {"action": "done"}, (1080, 2400), (460, 1024))
+           for _ in range(20)}
+    samples = load_dataset(str(tmp_path))
+    assert len(ids) == 20 and {s["id"] for s in samples} == ids
+    assert all((tmp_path / s["frame"]).exists() for s in samples)
@@ -0,0 +1,84 @@
+import os, time
+
+from trace_archive import TraceArchive, list_runs, load_run
+
+
+def _archive(tmp_path, **kw):
+    kw.setdefault("gc_grace_s", 0)
+    return TraceArchive(str(tmp_path), **kw)
+
+
+def _write_run(archive, goal, frames):
+    run = archive.start_run(goal)
+    for i, frame in enumerate(frames):
+        run.log(i, "think", frame=frame, prompt="p" * 1000, response=f"resp {i}")
+    run.close(status="done")
+    archive.flush()
+    return run.run_id
+
+
+def test_round_trip(tmp_path):
+    archive = _archive(tmp_path)
+    long_response = "x" * 1000
+    run = archive.start_run("Open Settings", device="emu")
+    run.log(0, "think", frame=b"frame-a", prompt="short", response=long_response, action={"action": "tap"})
+    run.log(1, "verify", frame=b"frame-a", response="ok")
+    run.close(status="done")
+    archive.flush()
+
+    assert list_runs(str(tmp_path)) == [run.run_id]
+    loaded = load_run(run.run_id, str(tmp_path))
+    assert loaded["run"]["goal"] == "Open Settings" and loaded["run"]["device"] == "emu"
+    assert loaded["end"]["status"] == "done"
+    first, second = loaded["steps"]
+    assert first["prompt"] == "short" and first["response"] == long_response
+    assert first["action"] == {"action": "tap"}
+    with open(first["frame_path"], "rb") as f:
+        assert f.read() == b"frame-a"
+    # 相同帧只存一份
+    assert first["frame_path"] == second["frame_path"]
+    assert len(os.listdir(os.path.dirname(first["frame_path"]))) == 1
+
+
+def test_retention_drops_oldest_runs_and_keeps_shared_objects(tmp_path):
+    archive = _archive(tmp_path)
+    shared = b"home" * 2000
+    ids = [_write_run(archive, f"goal {i}", [shared, bytes([i]) * 50000]) for i in range(4)]
+    now = time.time()
+    for age, run_id in zip((400, 300, 200, 100), ids):
+        path = os.path.join(archive.runs_dir, f"{run_id}.jsonl")
+        os.utime(path, (now - age, now - age))
+
+    archive.max_bytes = archive._disk_usage() - 60000
+    archive.enforce_retention()
+
+    assert archive._disk_usage() <= archive.max_bytes
+    # run_id 同一秒内的后缀是随机的，按集合比较
+    assert sorted(list_runs(str(tmp_path))) == sorted(ids[2:])
+    for run_id in ids[2:]:
+        for step in load_run(run_id, str(tmp_path))["steps"]:
+            assert os.path.exists(step["frame_path"])
+    # 被删运行独占的帧已回收，共享帧保留
+    objects = {n for _, _, files in os.walk(archive.objects_dir) for n in files}
+    assert len(objects) == 1 + 2 + 1  # 共享帧 + 两个独占帧 + 共享的长 prompt
+
+
+def test_retention_keeps_newest_run(tmp_path):
+    archive = _archive(tmp_path)
+    run_id = _write_run(archive, "only", [b"z" * 10000])
+    archive.max_bytes = 1
+    archive.enforce_retention()
+    assert list_runs(str(tmp_path)) == [run_id]
+
+
+def test_gc_skips_objects_within_grace_period(tmp_path):
+    archive = _archive(tmp_path, gc_grace_s=600)
+    orphan = os.path.join(archive.objects_dir, "ab", "ab" + "0" * 62)
+    os.makedirs(os.path.dirname(orphan))
+    with open(orphan, "wb") as f:
+        f.write(b"orphan")
+    assert archive.gc() == 0 and os.path.exists(orphan)
+
+    old = time.time() - 3600
+    os.utime(orphan, (old, old))
+    assert archive.gc() == 1 and not os.path.exists(orphan)
@@ -0,0 +1,268 @@
+"""
+截图 / prompt / 模型回复归档，用于排查线上失败。
+
+- 内容寻址：截图和大段文本按 sha256 存放在 objects/ab/abcdef...，相同的桌面/弹窗帧只存一份
+- 后台写入：主循环只把记录放进有界队列，磁盘 I/O 在守护线程里做；队列满时丢弃并计数，绝不阻塞
+- 每次运行一个紧凑的清单 runs/<run_id>.jsonl，每行一个步骤，只引用对象哈希
+- 按总大小淘汰：超过 TRACE_ARCHIVE_MAX_MB 时从最旧的运行开始删除，再回收无人引用的对象
+- 回收跳过 TRACE_GC_GRACE_S 内新写的对象：其它进程可能刚写完对象、还没写清单行
+
+用法:
+  archive = TraceArchive()              # TRACE_ARCHIVE_DIR，默认 trace_archive/
+  run = archive.start_run(goal)
+  run.log(step, "think", frame=png, prompt=text, response=raw_text, action=action)
+  run.close()
+
+  python trace_archive.py list
+  python trace_archive.py show <run_id>
+  python trace_archive.py gc
+"""
+import os, sys, json, time, uuid, queue, hashlib, threading
+from typing import Dict, Any, List
+
+TRACE_ARCHIVE_DIR = os.getenv("TRACE_ARCHIVE_DIR", "trace_archive")
+TRACE_ARCHIVE_MAX_MB = float(os.getenv("TRACE_ARCHIVE_MAX_MB", "2048"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "256"))
+TRACE_GC_GRACE_S = float(os.getenv("TRACE_GC_GRACE_S", "600"))
+_INLINE_TEXT_MAX = 256  # 短文本直接写进清单，长文本走内容寻址
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class TraceArchive:
+    def __init__(self, root: str = TRACE_ARCHIVE_DIR, max_mb: float = TRACE_ARCHIVE_MAX_MB,
+                 queue_size: int = TRACE_QUEUE_SIZE, gc_grace_s: float = TRACE_GC_GRACE_S):
+        self.root = root
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.gc_grace_s = gc_grace_s
+        self.objects_dir = os.path.join(root, "objects")
+        self.runs_dir = os.path.join(root, "runs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.runs_dir, exist_ok=True)
+        self.dropped = 0
+        self._q = queue.Queue(maxsize=queue_size)
+        self._known = set()  # 本进程已确认存在的对象，跳过重复 stat
+        self._writer = threading.Thread(target=self._loop, name="trace-archive-writer", daemon=True)
+        self._writer.start()
+
+    # ---------- 热路径（主循环调用） ----------
+    def start_run(self, goal: str, **meta) -> "TraceRun":
+        run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        run = TraceRun(self, run_id)
+        self._submit(("line", run_id, {"type": "run", "run_id": run_id, "goal": goal, "ts": time.time(), **meta}))
+        return run
+
+    def _submit(self, item) -> bool:
+        try:
+            self._q.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: float = 10.0):
+        """等待队列写完（退出前调用）；超时就放弃，不阻塞退出"""
+        deadline = time.monotonic() + timeout
+        while self._q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    # ---------- 后台写入 ----------
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _put_object(self, digest: str, data: bytes):
+        if digest in self._known:
+            return
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        self._known.add(digest)
+
+    def _loop(self):
+        writes = 0
+        while True:
+            item = self._q.get()
+            try:
+                kind, run_id, payload = item
+                if kind == "line":
+                    for digest, data in payload.pop("_objects", ()):
+                        self._put_object(digest, data)
+                    with open(os.path.join(self.runs_dir, f"{run_id}.jsonl"), "a", encoding="utf-8") as f:
+                        f.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")) + "\n")
+                    writes += 1
+                    if writes % 50 == 0:
+                        self.enforce_retention()
+                elif kind == "close":
+                    self.enforce_retention()
+            except Exception as e:
+                print("[TRACE] write failed:", e)
+            finally:
+                self._q.task_done()
+
+    # ---------- 淘汰 ----------
+    def _disk_usage(self):
+        total = 0
+        for d, _, files in os.walk(self.root):
+            for name in files:
+                total += os.path.getsize(os.path.join(d, name))
+        return total
+
+    def _run_refs(self) -> Dict[str, set]:
+        """{清单路径: 它引用的对象哈希}，每个清单只读一遍"""
+        refs = {}
+        for name in os.listdir(self.runs_dir):
+            path = os.path.join(self.runs_dir, name)
+            refs[path] = {v for rec in _read_jsonl(path) for k, v in rec.items() if k.endswith("_sha")}
+        return refs
+
+    def enforce_retention(self):
+        """超过上限时按修改时间删除最旧的运行清单，然后回收无人引用的对象。
+        先按引用计数算出要删哪些运行（删到只剩共享对象为止不会多算），再一次性删除、回收一次"""
+        usage = self._disk_usage()
+        if usage <= self.max_bytes:
+            return
+        refs = self._run_refs()
+        count = {}
+        for shas in refs.values():
+            for digest in shas:
+                count[digest] = count.get(digest, 0) + 1
+        runs = sorted(refs, key=os.path.getmtime)
+        doomed = []
+        # 至少保留最新的一次运行（通常就是正在写的那次）
+        for path in runs[:-1]:
+            if usage <= self.max_bytes:
+                break
+            doomed.append(path)
+            usage -= os.path.getsize(path)
+            for digest in refs.pop(path):
+                count[digest] -= 1
+                obj = self.object_path(digest)
+                if not count[digest] and os.path.exists(obj):
+                    usage -= os.path.getsize(obj)
+        for path in doomed:
+            os.remove(path)
+        if doomed:
+            self.gc(live=set().union(*refs.values()))
+
+    def gc(self, live: set = None) -> int:
+        """删除所有清单都不再引用、且写入超过 gc_grace_s 的对象，返回删除个数"""
+        if live is None:
+            live = set().union(*self._run_refs().values())
+        cutoff = time.time() - self.gc_grace_s
+        removed = 0
+        for d, _, files in os.walk(self.objects_dir):
+            for name in files:
+                path = os.path.join(d, name)
+                if name in live or os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+                self._known.discard(name)
+                removed += 1
+        return removed
+
+
+class TraceRun:
+    def __init__(self, archive: TraceArchive, run_id: str):
+        self.archive = archive
+        self.run_id = run_id
+
+    def log(self, step: int, stage: str, frame: bytes = None, prompt: str = None, response: str = None, **fields):
+        """记录一个步骤；哈希在调用线程算（很快），文件写入交给后台线程"""
+        rec = {"type": "step", "step": step, "stage": stage, "ts": round(time.time(), 3)}
+        objects = []
+        if frame:
+            digest = _sha256(frame)
+            rec["frame_sha"] = digest
+            objects.append((digest, frame))
+        for key, text in (("prompt", prompt), ("response", response)):
+            if text is None:
+                continue
+            if len(text) <= _INLINE_TEXT_MAX:
+                rec[key] = text
+            else:
+                data = text.encode("utf-8")
+                digest = _sha256(data)
+                rec[f"{key}_sha"] = digest
+                objects.append((digest, data))
+        rec.update(fields)
+        rec["_objects"] = objects
+        self.archive._submit(("line", self.run_id, rec))
+
+    def close(self, **summary):
+        self.archive._submit(("line", self.run_id, {"type": "end", "ts": time.time(), **summary}))
+        self.archive._submit(("close", self.run_id, None))
+
+
+# ---------- 读取 ----------
+def _read_jsonl(path: str) -> List[Dict[str, Any]]:
+    out = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                out.append(json.loads(line))
+    return out
+
+
+def list_runs(root: str = TRACE_ARCHIVE_DIR) -> List[str]:
+    runs_dir = os.path.join(root, "runs")
+    if not os.path.isdir(runs_dir):
+        return []
+    return sorted(n[:-len(".jsonl")] for n in os.listdir(runs_dir) if n.endswith(".jsonl"))
+
+
+def load_run(run_id: str, root: str = TRACE_ARCHIVE_DIR, with_text: bool = True) -> Dict[str, Any]:
+    """重建一次运行的时间线：帧给出对象路径，长文本按需读回"""
+    objects_dir = os.path.join(root, "objects")
+    records = _read_jsonl(os.path.join(root, "runs", f"{run_id}.jsonl"))
+    header = next((r for r in records if r["type"] == "run"), {})
+    end = next((r for r in records if r["type"] == "end"), None)
+    timeline = []
+    for r in records:
+        if r["type"] != "step":
+            continue
+        entry = dict(r)
+        if "frame_sha" in r:
+            entry["frame_path"] = os.path.join(objects_dir, r["frame_sha"][:2], r["frame_sha"])
+        for key in ("prompt", "response"):
+            digest = r.get(f"{key}_sha")
+            if digest and with_text:
+                path = os.path.join(objects_dir, digest[:2], digest)
+                entry[key] = None
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        entry[key] = f.read()
+        timeline.append(entry)
+    timeline.sort(key=lambda e: (e["step"], e["ts"]))
+    return {"run": header, "steps": timeline, "end": end}
+
+
+def main():
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if cmd == "list":
+        for run_id in list_runs():
+            print(run_id)
+    elif cmd == "show" and len(sys.argv) > 2:
+        run = load_run(sys.argv[2])
+        print("[RUN]", run["run"].get("goal"), run["run"].get("run_id"))
+        for e in run["steps"]:
+            frame = os.path.basename(e.get("frame_path", ""))[:12]
+            resp = (e.get("response") or "").replace("\n", " ")[:100]
+            print(f"  step={e['step']:<3} {e['stage']:<7} frame={frame:<12} {resp}")
+        print("[END]", run["end"])
+    elif cmd == "gc":
+        archive = TraceArchive()
+        archive.enforce_retention()
+        print("removed", archive.gc(), "unreferenced objects")
+    else:
+        print("usage: python trace_archive.py list | show <run_id> | gc")
+
+
+if __name__ == "__main__":
+    main()